@@ -1,10 +1,15 @@
 from django.contrib import admin
 
-from contacts_import.models import TransientContact
+from contacts_import.models import ImportSyncState, TransientContact
 
 
 class TransientContactAdmin(admin.ModelAdmin):
     pass
 
 
-admin.site.register(TransientContact, TransientContactAdmin)
\ No newline at end of file
+class ImportSyncStateAdmin(admin.ModelAdmin):
+    list_display = ["owner", "provider", "updated"]
+
+
+admin.site.register(TransientContact, TransientContactAdmin)
+admin.site.register(ImportSyncState, ImportSyncStateAdmin)
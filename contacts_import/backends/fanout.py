@@ -0,0 +1,141 @@
+"""
+Splits a large asynchronous import over several Celery tasks. The import
+task keeps fetching, parsing and merging contacts and persists the first
+chunk itself; every further chunk is handed to a ``PersistChunkTask`` so
+that they are written in parallel by whichever workers are free.
+
+Completion is tracked in the cache, chord style: each chunk task stores
+its partial status and increments a counter, and so does the import task
+once it has dispatched the last chunk. Whoever brings the counter to the
+number of chunks plus one aggregates the partial statuses, finalizes the
+persistance backend and reports the import as done, or as failed if a
+chunk task failed. The cache must be
+shared by the workers and support atomic ``incr`` (memcached, redis).
+"""
+
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from contacts_import.instrumentation import emit
+from contacts_import.progress import ProgressTracker
+
+
+FAN_OUT_TIMEOUT = getattr(settings, "CONTACTS_IMPORT_FAN_OUT_TIMEOUT", 60 * 60)
+
+
+def fan_out_key(group_id, name):
+    return "contacts_import:fanout:%s:%s" % (group_id, name)
+
+
+class ChunkFanOut(object):
+    
+    def __init__(self, importer, persistance, credentials, task_id):
+        self.importer = importer
+        self.persistance = persistance
+        self.credentials = {"user": credentials["user"]}
+        self.task_id = task_id
+        self.group_id = task_id or uuid.uuid4().hex
+        self.chunks = 0
+        cache.set(fan_out_key(self.group_id, "done"), 0, FAN_OUT_TIMEOUT)
+    
+    def dispatch(self, chunk):
+        from contacts_import.tasks import PersistChunkTask
+        PersistChunkTask.delay(self.group_id, self.chunks, chunk,
+            self.persistance.__class__(), self.credentials
+        )
+        self.chunks += 1
+    
+    def close(self, status, started, sync_state=None):
+        """
+        Hands the status of the import task, and the ``ImportSyncState`` to
+        store if every chunk is persisted, over to whoever finishes last.
+        """
+        importer = self.importer.__class__
+        cache.set(fan_out_key(self.group_id, "parent"), {
+            # by path: the class of an importer run by Celery is made by
+            # get_task and can't be pickled, the importer it stands for can
+            "importer": "%s.%s" % (importer.__module__, importer.__name__),
+            "persistance": self.persistance.__class__(),
+            "credentials": self.credentials,
+            "task_id": self.task_id,
+            "chunks": self.chunks,
+            "status": status,
+            "started": started,
+            "sync_state": sync_state,
+        }, FAN_OUT_TIMEOUT)
+        part_done(self.group_id)
+        return status
+
+
+def persist_chunk(group_id, index, chunk, persistance, credentials):
+    """
+    Persists one chunk on behalf of an import; run by ``PersistChunkTask``.
+    """
+    start = time.time()
+    try:
+        persistance.open(credentials)
+        status = persistance.persist_chunk(chunk, persistance.default_status(), credentials)
+        status = persistance.flush(status, credentials)
+    except Exception:
+        # the import must still be reported, as failed
+        cache.set(fan_out_key(group_id, "part:%d" % index), {"failed": True}, FAN_OUT_TIMEOUT)
+        part_done(group_id)
+        raise
+    cache.set(fan_out_key(group_id, "part:%d" % index), {
+        "status": status,
+        "persist": time.time() - start,
+        "queries": persistance.queries,
+    }, FAN_OUT_TIMEOUT)
+    part_done(group_id)
+    return status
+
+
+def part_done(group_id):
+    done = cache.incr(fan_out_key(group_id, "done"))
+    parent = cache.get(fan_out_key(group_id, "parent"))
+    if parent is not None and done == parent["chunks"] + 1:
+        finish(group_id, parent)
+
+
+def finish(group_id, parent):
+    keys = [fan_out_key(group_id, "part:%d" % index) for index in xrange(parent["chunks"])]
+    parts = cache.get_many(keys)
+    cache.delete_many(keys + [fan_out_key(group_id, name) for name in ("done", "parent")])
+    credentials = parent["credentials"]
+    progress = None
+    if parent["task_id"] is not None:
+        progress = ProgressTracker(parent["task_id"], credentials["user"])
+    status = parent["status"]
+    stats = status.pop("stats")
+    if len(parts) != len(keys):
+        # evicted before we got to them
+        if progress is not None:
+            progress.update(stats["contacts"], status, state="FAILURE")
+        raise RuntimeError("Partial results of import %s are missing" % group_id)
+    failed = [part for part in parts.itervalues() if part.get("failed")]
+    for part in parts.itervalues():
+        if part.get("failed"):
+            continue
+        for key, value in part["status"].iteritems():
+            status[key] = status.get(key, 0) + value
+        stats["persist"] += part["persist"]
+        stats["queries"] += part["queries"]
+    status = parent["persistance"].finalize(status, credentials)
+    stats["total"] = time.time() - parent["started"]
+    stats["rate"] = stats["total"] and stats["contacts"] / stats["total"] or 0.0
+    status["stats"] = stats
+    if failed:
+        # the failed chunk task raised already
+        if progress is not None:
+            progress.update(stats["contacts"], status, state="FAILURE")
+        return status
+    if parent["sync_state"] is not None:
+        parent["sync_state"].save()
+    from contacts_import.settings import import_attr
+    emit(import_attr(parent["importer"])(), stats, status, credentials)
+    if progress is not None:
+        progress.update(stats["contacts"], status, state="DONE")
+    return status
@@ -1,69 +1,474 @@
-import httplib2
-import vobject
+import csv
+import logging
+import threading
+import urllib
 
 from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.http import HttpResponseRedirect
 from django.utils import simplejson as json
 
-from contacts_import.backends.runners import AsyncRunner
-from contacts_import.settings import RUNNER
+from contacts_import.backends.fanout import ChunkFanOut
+from contacts_import.instrumentation import ImportStats, emit, timed
+from contacts_import.models import ImportSyncState
+from contacts_import.progress import ProgressTracker
+from contacts_import.utils import httppool, staging
+from contacts_import.utils.csvfile import iter_csv_contacts
+from contacts_import.utils.dedupe import ContactMerger
+from contacts_import.utils.emails import iter_emails
+from contacts_import.utils.ldif import iter_ldif_contacts
+from contacts_import.utils.pool import get_pool, prefetch
+from contacts_import.utils.records import ImportedContact, chunked_contacts
+from contacts_import.utils.vcard import iter_vcards
+
+
+logger = logging.getLogger("contacts_import")
+
+# skipped entries listed in the status of an import; all are counted
+REJECTED_REPORTED = 10
+
+_tasks = {}
+_tasks_lock = threading.Lock()
 
 
-# determine the base class based on what type of importing should be done
-if issubclass(RUNNER, AsyncRunner):
+def get_task(importer):
+    """
+    The Celery task running ``importer``, a subclass of both made the first
+    time it is asked for; only processes that run imports on Celery import
+    it.
+    """
+    try:
+        return _tasks[importer]
+    except KeyError:
+        pass
     from celery.task import Task
-else:
-    Task = object
+    with _tasks_lock:
+        if importer not in _tasks:
+            # the same name, and so the same task name, as the importer
+            _tasks[importer] = type(importer.__name__, (importer, Task), {
+                "__module__": importer.__module__,
+            })
+    return _tasks[importer]
 
 
-class BaseImporter(Task):
-    def run(self, credentials, persistance):
-        status = {
-            "imported": 0,
-            "total": 0,
-        }
-        for contact in self.get_contacts(credentials):
-            status = persistance.persist(contact, status, credentials)
+class BaseImporter(object):
+    # name used to look up per provider settings, and the importer's name
+    # in contacts_import.backends.registry
+    provider = None
+    # session keys a login callback leaves the provider's credentials in,
+    # handed to the importer under the same names
+    credential_keys = ()
+    # dotted path of the form asking for the credentials of a source that
+    # needs no login, such as an upload
+    form = None
+    # number of contacts handed to the persistance backend at once; each
+    # chunk is committed on its own
+    chunk_size = getattr(settings, "CONTACTS_IMPORT_CHUNK_SIZE", 500)
+    
+    # ImportStats of the running import
+    stats = None
+    # (line, token, reason) of what the running import skipped, reported in
+    # its status
+    rejected = None
+    # only ask providers for what changed since the last import
+    incremental = getattr(settings, "CONTACTS_IMPORT_INCREMENTAL", False)
+    # ImportSyncState of a running incremental import and what to store in
+    # it once the import succeeds
+    sync_state = None
+    next_sync_token = None
+    next_etag = None
+    sync_failed = False
+    
+    def run(self, credentials, persistance, task_id=None, dispatched=None, fan_out=False, **kwargs):
+        if task_id is None:
+            # newer Celery versions no longer pass task_id along
+            task_id = getattr(getattr(self, "request", None), "id", None)
+        if "staged_stream" not in credentials:
+            return self.run_import(credentials, persistance, task_id, dispatched, fan_out)
+        credentials = staging.unstage(credentials)
+        try:
+            return self.run_import(credentials, persistance, task_id, dispatched, fan_out)
+        finally:
+            staging.discard(credentials)
+    
+    def run_import(self, credentials, persistance, task_id, dispatched, fan_out):
+        self.reset()
+        progress = None
+        if task_id is not None:
+            progress = ProgressTracker(task_id, credentials["user"])
+        self.stats = stats = ImportStats()
+        if dispatched is not None:
+            stats.queued = max(stats.started - dispatched, 0.0)
+        persistance.open(credentials)
+        status = persistance.default_status()
+        seen = 0
+        # everything spent pulling contacts out of the importer counts as
+        # parsing, less the time spent waiting on the provider
+        contacts = timed(self.get_contacts(credentials), stats, "parse")
+        merger = ContactMerger.from_settings()
+        dispatcher = None
+        try:
+            for index, chunk in enumerate(chunked_contacts(contacts, self.chunk_size)):
+                seen += len(chunk)
+                if merger is not None:
+                    chunk = merger.merge(chunk)
+                if index and fan_out:
+                    # the first chunk is persisted here, the others by
+                    # PersistChunkTasks running alongside
+                    if dispatcher is None:
+                        dispatcher = ChunkFanOut(self, persistance, credentials, task_id)
+                    dispatcher.dispatch(chunk)
+                else:
+                    with stats.timer("persist"):
+                        status = persistance.persist_chunk(chunk, status, credentials)
+                if progress is not None:
+                    progress.update(seen, status)
+            with stats.timer("persist"):
+                status = persistance.flush(status, credentials)
+                if dispatcher is None:
+                    status = persistance.finalize(status, credentials)
+        except Exception:
+            if progress is not None:
+                progress.update(seen, status, state="FAILURE")
+            raise
+        if dispatcher is None:
+            self.save_sync_state()
+        stats.finish()
+        stats.timings["parse"] = max(stats.timings["parse"] - stats.timings["fetch"], 0.0)
+        stats.contacts = seen
+        stats.merged = merger is not None and merger.merged or 0
+        stats.queries = persistance.queries
+        status["stats"] = stats.as_dict()
+        if self.rejected:
+            status["rejected"] = self.rejected[:REJECTED_REPORTED]
+            status["rejected_count"] = len(self.rejected)
+        if dispatcher is not None:
+            # the last of the chunk tasks to finish reports the import, and
+            # stores the sync state if they all succeeded
+            return dispatcher.close(status, stats.started, self.updated_sync_state())
+        emit(self, status["stats"], status, credentials)
+        if progress is not None:
+            progress.update(seen, status, state="DONE")
         return status
+    
+    def reset(self):
+        """
+        Forgets what the previous import left on the importer; Celery runs
+        every import of a worker on the same task instance.
+        """
+        self.stats = None
+        self.rejected = []
+        self.sync_state = None
+        self.next_sync_token = None
+        self.next_etag = None
+        self.sync_failed = False
+    
+    def load_sync_state(self, credentials):
+        """
+        Returns the ``ImportSyncState`` of the owner's last import from
+        this provider, or ``None`` if imports aren't incremental.
+        """
+        if not self.incremental:
+            return None
+        self.sync_state = ImportSyncState.objects.get_for(credentials["user"], self.provider)
+        return self.sync_state
+    
+    def updated_sync_state(self):
+        """
+        The ``ImportSyncState`` to store once the import succeeded, ``None``
+        if there is nothing to store.
+        """
+        state = self.sync_state
+        if state is None or self.sync_failed:
+            return None
+        if self.next_sync_token is None and self.next_etag is None:
+            return None
+        state.token = self.next_sync_token or ""
+        state.etag = self.next_etag or ""
+        return state
+    
+    def save_sync_state(self):
+        state = self.updated_sync_state()
+        if state is not None:
+            state.save()
+    
+    def cache_scope(self, credentials):
+        """
+        What provider responses are cached under, see ``utils.httpcache``.
+        """
+        user = credentials.get("user")
+        if user is None:
+            return None
+        return "%s:%s" % (self.provider, user.pk)
+    
+    def prefetch_workers(self):
+        """
+        How many pages may be fetched at once for this provider, as set in
+        ``CONTACTS_IMPORT_PREFETCH``. 0 fetches pages one after another.
+        """
+        return getattr(settings, "CONTACTS_IMPORT_PREFETCH", {}).get(self.provider, 0)
+    
+    def iter_pages(self, credentials):
+        """
+        Yields the contacts of each page of a provider's address book, as
+        returned by ``parse_page``, using ``fetch_page``, ``next_page_url``
+        and ``remaining_page_urls``. When prefetching is enabled and the
+        provider tells us how many pages there are, the following pages
+        are downloaded and parsed on a thread pool while the current one
+        is being persisted; they are still yielded in order. Decoded pages
+        are dropped as soon as they are parsed.
+        """
+        if self.stats is None:
+            self.stats = ImportStats()
+        stats = self.stats
+        url = self.first_page_url(credentials)
+        with stats.timer("fetch"):
+            page = self.fetch_page(url, credentials)
+        if page is None:
+            return
+        workers = self.prefetch_workers()
+        urls = workers and self.remaining_page_urls(page, url)
+        if urls:
+            contacts, page = self.parse_page(page), None
+            yield contacts
+            pool = get_pool("prefetch-%s" % self.provider, workers)
+            fetch = lambda url: self.fetch_contacts(url, credentials)
+            # only the time spent waiting on a page counts as fetching
+            for contacts in timed(prefetch(pool, fetch, urls, workers), stats, "fetch"):
+                if contacts is None:
+                    return
+                yield contacts
+            return
+        while page is not None:
+            next_url = self.next_page_url(page, url)
+            contacts, page = self.parse_page(page), None
+            yield contacts
+            if not next_url or next_url == url:
+                return
+            url = next_url
+            with stats.timer("fetch"):
+                page = self.fetch_page(url, credentials)
+    
+    def fetch_contacts(self, url, credentials):
+        page = self.fetch_page(url, credentials)
+        if page is None:
+            return None
+        return self.parse_page(page)
+    
+    def first_page_url(self, credentials):
+        raise NotImplementedError("Implement this in a paged importer")
+    
+    def fetch_page(self, url, credentials):
+        raise NotImplementedError("Implement this in a paged importer")
+    
+    def parse_page(self, page):
+        """
+        Returns the list of ``ImportedContact``\s found on ``page``.
+        """
+        raise NotImplementedError("Implement this in a paged importer")
+    
+    def next_page_url(self, page, url):
+        return None
+    
+    def remaining_page_urls(self, page, url):
+        """
+        Returns the URLs of every page after ``page`` or ``None`` when that
+        can't be known up front.
+        """
+        return None
+    
+    def login_url(self, request):
+        """
+        Where to send the user to give us access to their contacts, ``None``
+        if the provider needs no login. The generic views cache it in the
+        session.
+        """
+        return None
+    
+    def login_callback(self, request):
+        """
+        Stores the credentials the provider sent the user back with in the
+        session, under ``credential_keys``.
+        """
+        pass
 
 
 class VcardImporter(BaseImporter):
+    provider = "vcard"
+    form = "contacts_import.forms.VcardImportForm"
+    
     def get_contacts(self, credentials):
-        for card in vobject.readComponents(credentials["stream"]):
-            try:
-                yield {
-                    "email": card.email.value,
-                    "name": card.fn.value
-                }
-            except AttributeError:
-                # if a person doesn't have an email or a name ignore them
+        if self.stats is not None:
+            self.stats.add_bytes(getattr(credentials["stream"], "size", 0))
+        for name, emails in iter_vcards(credentials["stream"]):
+            # if a person doesn't have an email or a name ignore them
+            if not name:
                 continue
+            for email in emails:
+                yield ImportedContact(email, name)
+
+
+class FileImporter(BaseImporter):
+    """
+    Imports an uploaded address book with ``reader``.
+    """
+    # turns the stream into (name, emails) tuples
+    reader = None
+    # what reader raises on a file it can't make sense of at all
+    reader_errors = ()
+    
+    def read(self, stream):
+        return self.reader(stream)
+    
+    def get_contacts(self, credentials):
+        if self.stats is not None:
+            self.stats.add_bytes(getattr(credentials["stream"], "size", 0))
+        try:
+            for name, emails in self.read(credentials["stream"]):
+                for email in emails:
+                    yield ImportedContact(email, name)
+        except self.reader_errors, e:
+            logger.warning("%s import of an unreadable file: %s" % (self.provider, e))
+            if self.rejected is not None:
+                self.rejected.append((1, str(e), "unreadable"))
+
+
+class CsvImporter(FileImporter):
+    """
+    Imports an address book exported as CSV (Outlook, Gmail, Yahoo...),
+    see ``utils.csvfile``.
+    """
+    provider = "csv"
+    form = "contacts_import.forms.CsvImportForm"
+    reader = staticmethod(iter_csv_contacts)
+    reader_errors = (csv.Error,)
+    
+    def read(self, stream):
+        # rows that can't be read are skipped and reported
+        return self.reader(stream, rejected=self.rejected)
+
+
+class LdifImporter(FileImporter):
+    """
+    Imports an address book exported as LDIF (Thunderbird, Apple Contacts),
+    see ``utils.ldif``.
+    """
+    provider = "ldif"
+    form = "contacts_import.forms.LdifImportForm"
+    reader = staticmethod(iter_ldif_contacts)
 
 
 class EmailListImporter(BaseImporter):
+    provider = "email_list"
+    form = "contacts_import.forms.EmailListImportForm"
+    
     def get_contacts(self, credentials):
-        for email in credentials["stream"]:
-            yield {
-                "email": email,
-                "name": '',
-                }
+        stream = credentials["stream"]
+        if isinstance(stream, basestring):
+            stream = [stream]
+        # a list of addresses or of already parsed contacts works too
+        for item in stream:
+            if isinstance(item, dict):
+                yield ImportedContact(item["email"], item.get("name") or "")
+            else:
+                for contact in iter_emails(item):
+                    yield contact
+
+
+YAHOO_GUID_URI = "http://social.yahooapis.com/v1/me/guid?format=json"
+YAHOO_CONTACTS_URI = "http://social.yahooapis.com/v1/user/%s/contacts"
 
 
-class YahooImporter(BaseImporter):    
+class YahooImporter(BaseImporter):
+    provider = "yahoo"
+    # the OAuth dance with Yahoo is left to the project
+    credential_keys = ("yahoo_token",)
+    page_size = getattr(settings, "CONTACTS_IMPORT_YAHOO_PAGE_SIZE", 250)
+    
+    def api_call(self, url, credentials):
+        # Yahoo is called through oauth_access, set up with its
+        # OAUTH_ACCESS_SETTINGS, unless CONTACTS_IMPORT_YAHOO_CLIENT is
+        # "oauth_consumer" or oauth_access isn't installed; oAuthConsumer,
+        # set up with OAUTH_CONSUMER_SETTINGS, goes through the pooled and
+        # cached utils.httppool
+        if getattr(settings, "CONTACTS_IMPORT_YAHOO_CLIENT", "oauth_access") == "oauth_access":
+            try:
+                from oauth_access.access import OAuthAccess
+            except ImportError:
+                pass
+            else:
+                access = OAuthAccess("yahoo")
+                return access.make_api_call("json", url, credentials["yahoo_token"])
+        from contacts_import.oauth_consumer import oAuthConsumer
+        consumer = oAuthConsumer("yahoo", cache_scope=self.cache_scope(credentials))
+        data = consumer.make_api_call("json", url, credentials["yahoo_token"])
+        if self.stats is not None:
+            self.stats.add_bytes(consumer.received)
+        return data
+    
+    def page_url(self, contacts_uri, start):
+        return "%s?%s" % (contacts_uri, urllib.urlencode([
+            ("format", "json"),
+            ("view", "tinyusercard"),
+            ("start", start),
+            ("count", self.page_size),
+        ]))
+    
+    def first_page_url(self, credentials):
+        guid = self.api_call(YAHOO_GUID_URI, credentials)["guid"]["value"]
+        state = self.load_sync_state(credentials)
+        if state is not None and state.token:
+            return "%s/sync?%s" % (YAHOO_CONTACTS_URI % guid, urllib.urlencode([
+                ("format", "json"),
+                ("rev", state.token),
+            ]))
+        return self.page_url(YAHOO_CONTACTS_URI % guid, 0)
+    
+    def fetch_page(self, url, credentials):
+        data = self.api_call(url, credentials)
+        if "contactsync" in data:
+            # the changes since the last import, in a single page
+            sync = data["contactsync"]
+            contacts = [
+                contact for contact in sync.get("contacts", [])
+                if contact.get("op") != "remove"
+            ]
+            page = {
+                "start": 0,
+                "count": len(contacts),
+                "total": len(contacts),
+                "contact": contacts,
+                "rev": sync.get("rev"),
+            }
+        else:
+            page = data["contacts"]
+        if self.sync_state is not None and page.get("rev") is not None:
+            self.next_sync_token = str(max(int(page["rev"]), int(self.next_sync_token or 0)))
+        return page
+    
+    def next_page_url(self, page, url):
+        start = int(page.get("start", 0)) + int(page.get("count", 0))
+        if page.get("contact") and start < int(page.get("total", 0)):
+            return self.page_url(url.split("?")[0], start)
+        return None
+    
+    def remaining_page_urls(self, page, url):
+        start = int(page.get("start", 0)) + int(page.get("count", 0))
+        if not page.get("contact"):
+            return None
+        return [
+            self.page_url(url.split("?")[0], i)
+            for i in xrange(start, int(page.get("total", 0)), self.page_size)
+        ]
+    
     def get_contacts(self, credentials):
-        from oauth_access.access import OAuthAccess
-        yahoo_token = credentials["yahoo_token"]
-        access = OAuthAccess("yahoo")
-        guid = access.make_api_call(
-            "json",
-            "http://social.yahooapis.com/v1/me/guid?format=json",
-            yahoo_token
-        )["guid"]["value"]
-        address_book = access.make_api_call(
-            "json",
-            "http://social.yahooapis.com/v1/user/%s/contacts?format=json&count=max&view=tinyusercard" % guid,
-            yahoo_token,
-        )
-        for contact in address_book["contacts"]["contact"]:
+        for contacts in self.iter_pages(credentials):
+            for contact in contacts:
+                yield contact
+    
+    def parse_page(self, page):
+        contacts = []
+        for contact in page.get("contact", []):
             # e-mail (if not found skip contact)
             try:
                 email = self.get_field_value(contact, "email")
@@ -85,10 +490,8 @@ class YahooImporter(BaseImporter):
                     name = last_name
                 else:
                     name = ""
-            yield {
-                "email": email,
-                "name": name,
-            }
+            contacts.append(ImportedContact(email, name))
+        return contacts
     
     def get_field_value(self, contact, kind):
         try:
@@ -103,58 +506,119 @@ class YahooImporter(BaseImporter):
 
 
 
-from gdata.contacts.service import ContactsService
-from gdata.auth import GenerateAuthSubUrl
-
-from django.http import HttpResponseRedirect
-from django.core.urlresolvers import reverse
-
-from contacts_import.settings import RUNNER, CALLBACK
-
-GOOGLE_CONTACTS_URI = "http://www.google.com/m8/feeds/contacts/default/full?alt=json&max-results=1000"
+GOOGLE_CONTACTS_URI = "http://www.google.com/m8/feeds/contacts/default/full"
 
 class GoogleImporter(BaseImporter):
+    provider = "google"
+    credential_keys = ("authsub_token",)
+    contacts_uri = GOOGLE_CONTACTS_URI
+    page_size = getattr(settings, "CONTACTS_IMPORT_GOOGLE_PAGE_SIZE", 250)
+    # set by incremental imports to only get contacts changed since then
+    updated_min = None
+    # the URL of the first page, which may be answered with a 304
+    first_url = None
+    
     def login_url(self, request):
-        next = request.build_absolute_uri(reverse('import_google_contacts'))
+        # gdata is only needed, and only imported, to talk AuthSub
+        from gdata.auth import GenerateAuthSubUrl
+        next = request.build_absolute_uri(
+            reverse("contacts_import_callback", kwargs={"provider": self.provider})
+        )
         scope = 'http://www.google.com/m8/feeds/'
         return GenerateAuthSubUrl(next, scope, secure=False, session=True)
 
     def login_callback(self, request, redirect_to=None):
         if "token" in request.GET:
+            from gdata.contacts.service import ContactsService
             token_login = request.GET["token"]
             gcs = ContactsService()
             gcs.SetAuthSubToken(token_login)
             request.session["authsub_token"] = gcs.GetAuthSubToken()
 
         return HttpResponseRedirect(request.build_absolute_uri())
-
-
-    def import_contacts(self, request):
-        runner_class = RUNNER
-        authsub_token = request.session.pop("authsub_token", None)
-        if authsub_token:
-            runner = runner_class(GoogleImporter,
-                                  user = request.user,
-                                  authsub_token = authsub_token
-                                  )
-            results = runner.import_contacts()
-            from ..views import _import_success
-            return _import_success(request, results)
-
-
-    def get_contacts(self, credentials):
-        h = httplib2.Http()
-        response, content = h.request(GOOGLE_CONTACTS_URI, headers={
+    
+    def reset(self):
+        super(GoogleImporter, self).reset()
+        self.updated_min = None
+        self.first_url = None
+    
+    def page_url(self, start_index):
+        query = [
+            ("alt", "json"),
+            ("max-results", self.page_size),
+            ("start-index", start_index),
+        ]
+        if self.updated_min:
+            query.append(("updated-min", self.updated_min))
+        return "%s?%s" % (self.contacts_uri, urllib.urlencode(query))
+    
+    def first_page_url(self, credentials):
+        state = self.load_sync_state(credentials)
+        if state is not None and state.token:
+            self.updated_min = state.token
+        self.first_url = self.page_url(1)
+        return self.first_url
+    
+    def fetch_page(self, url, credentials):
+        """
+        Returns the decoded feed found at ``url`` or ``None`` if Google
+        refused the request or nothing changed since the last import.
+        """
+        headers = {
             "Authorization": 'AuthSub token="%s"' % credentials["authsub_token"]
-        })
-
+        }
+        first = self.sync_state is not None and url == self.first_url
+        if first and self.sync_state.etag:
+            headers["If-None-Match"] = self.sync_state.etag
+        response, content = httppool.request(url,
+            headers = headers,
+            cache_scope = self.cache_scope(credentials),
+        )
+        if self.stats is not None and not getattr(response, "fromcache", False):
+            self.stats.add_bytes(len(content))
+        if response.status == 304:
+            return None
         if response.status != 200:
-            return
-
-        results = json.loads(content)
-        for person in results["feed"]["entry"]:
-            for email in person.get("gd$email", []):
-                yield {
-                    "name": person["title"]["$t"],
-                    "email": email["address"],
-                }
+            self.sync_failed = True
+            return None
+        feed = json.loads(content)["feed"]
+        if first:
+            # Google's clock, not ours, for the next updated-min
+            self.next_sync_token = feed.get("updated", {}).get("$t")
+            self.next_etag = response.get("etag")
+        return feed
+    
+    def next_page_url(self, feed, url):
+        for link in feed.get("link", []):
+            if link.get("rel") == "next":
+                return link["href"]
+        # no next link; work it out from the OpenSearch elements if present
+        urls = self.remaining_page_urls(feed, url)
+        if urls:
+            return urls[0]
+        return None
+    
+    def remaining_page_urls(self, feed, url):
+        try:
+            total = int(feed["openSearch$totalResults"]["$t"])
+            start = int(feed["openSearch$startIndex"]["$t"])
+        except (KeyError, ValueError):
+            return None
+        if not feed.get("entry"):
+            return None
+        start += len(feed["entry"])
+        return [self.page_url(i) for i in xrange(start, total + 1, self.page_size)]
+    
+    def get_contacts(self, credentials):
+        # the contacts of one page of the feed are held in memory at a time
+        # (a few more when prefetching); the decoded feed is not kept
+        for contacts in self.iter_pages(credentials):
+            for contact in contacts:
+                yield contact
+    
+    def parse_page(self, feed):
+        return [
+            ImportedContact(email["address"], person["title"]["$t"])
+            for person in feed.get("entry", [])
+            for email in person.get("gd$email", [])
+        ]
@@ -1,7 +1,124 @@
+import os
+import sqlite3
+import tempfile
+import threading
+
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    # Django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+
 from contacts_import.models import TransientContact
+from contacts_import.utils.records import ContactChunk, ImportedContact, chunked_contacts
+
+
+def insert_contact(obj):
+    """
+    Saves a new ``TransientContact`` relying on the (owner, email) unique
+    constraint instead of reading first. Returns ``False`` if the owner
+    already had that email, which is also what happens when a concurrent
+    import got there first.
+    """
+    sid = transaction.savepoint()
+    try:
+        obj.save(force_insert=True)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return False
+    transaction.savepoint_commit(sid)
+    return True
+
+
+def update_name(owner, email, name):
+    """
+    Gives an existing contact the name the provider now has for it. Returns
+    whether anything changed; an empty name never overwrites one.
+    """
+    if not name:
+        return False
+    return TransientContact.objects.filter(
+        owner = owner,
+        email = email,
+    ).exclude(name=name).update(name=name) > 0
+
+
+def counts_queries(method):
+    """
+    Adds the queries run by ``method`` to the ``queries`` of the backend,
+    as logged by the debug cursor, which is turned on for the duration.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.counting:
+            # the outermost call counts
+            return method(self, *args, **kwargs)
+        # Django >= 1.8 renamed both
+        flag = "force_debug_cursor" if hasattr(connection, "force_debug_cursor") else "use_debug_cursor"
+        log = getattr(connection, "queries_log", None)
+        if log is None:
+            log = connection.queries
+        forced = getattr(connection, flag)
+        setattr(connection, flag, True)
+        start = len(log)
+        self.counting = True
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.counting = False
+            self.queries += len(log) - start
+            setattr(connection, flag, forced)
+            if not (forced or settings.DEBUG):
+                # don't keep a log nobody asked for
+                for i in xrange(len(log) - start):
+                    log.pop()
+    return wrapper
 
 
 class BasePersistance(object):
+    """
+    Importers drive a persistance backend through the following lifecycle:
+        
+        open(credentials)
+        persist_chunk(contacts, status, credentials)  # once per chunk
+        flush(status, credentials)
+        finalize(status, credentials)
+    
+    Backends that work one contact at a time only need to implement
+    ``persist_contact``. Chunks are ``ContactChunk``\s and contacts
+    ``ImportedContact``\s, which behave like ``{"email", "name"}`` dicts.
+    
+    The status counts the contacts ``added``, ``updated`` (the owner had
+    them under another name) and ``unchanged``; ``imported`` is the same as
+    ``added`` and ``total`` the number of contacts handed over.
+    """
+    
+    # number of queries issued, reported in the import stats; backends
+    # that use the database count them with ``counts_queries``
+    queries = 0
+    counting = False
+    
+    def default_status(self):
+        return {
+            "imported": 0,
+            "total": 0,
+            "added": 0,
+            "updated": 0,
+            "unchanged": 0,
+        }
+    
+    def open(self, credentials):
+        pass
+    
+    def persist_chunk(self, contacts, status, credentials):
+        for contact in contacts:
+            status = self.persist(contact, status, credentials)
+        return status
+    
     def persist(self, contact, status, credentials):
         if status is None:
             status = self.default_status()
@@ -9,26 +126,307 @@ class BasePersistance(object):
     
     def persist_contact(self, contact, status, credentials):
         return status
+    
+    def flush(self, status, credentials):
+        """
+        Called once the importer has handed over every contact. Backends
+        that buffer contacts must write out what is left here.
+        """
+        return status
+    
+    def finalize(self, status, credentials):
+        return status
 
 
 class ModelPersistance(BasePersistance):
     
+    @counts_queries
+    def persist_chunk(self, contacts, status, credentials):
+        with atomic():
+            return super(ModelPersistance, self).persist_chunk(
+                contacts, status, credentials
+            )
+    
+    @counts_queries
+    def persist(self, contact, status, credentials):
+        return super(ModelPersistance, self).persist(contact, status, credentials)
+    
+    @counts_queries
+    def flush(self, status, credentials):
+        return super(ModelPersistance, self).flush(status, credentials)
+    
     def persist_contact(self, contact, status, credentials):
-        obj, created = TransientContact.objects.get_or_create(
-            owner = credentials["user"],
+        owner = credentials["user"]
+        created = insert_contact(TransientContact(
+            owner = owner,
             email = contact["email"],
-            defaults = {"name": contact["name"]}
-        )
+            name = contact["name"],
+        ))
         status["total"] += 1
         if created:
             status["imported"] += 1
+            status["added"] += 1
+            return status
+        if update_name(owner, contact["email"], contact["name"]):
+            status["updated"] += 1
+        else:
+            status["unchanged"] += 1
+        return status
+    
+    def finalize(self, status, credentials):
+        TransientContact.objects.invalidate_count(credentials["user"])
+        return status
+
+
+class BulkModelPersistance(ModelPersistance):
+    """
+    Buffers contacts and writes them out ``batch_size`` at a time: one query
+    to find which emails the owner already has, one ``bulk_create`` for the
+    rest and an ``UPDATE`` for each contact whose name changed. Behaves
+    like ``ModelPersistance`` as far as the status goes.
+    """
+    
+    def __init__(self, batch_size=None):
+        if batch_size is None:
+            batch_size = getattr(settings, "CONTACTS_IMPORT_BULK_BATCH_SIZE", 500)
+        self.batch_size = batch_size
+        self.buffer = ContactChunk()
+    
+    @counts_queries
+    def persist_chunk(self, contacts, status, credentials):
+        self.buffer.extend(contacts)
+        with atomic():
+            while len(self.buffer) >= self.batch_size:
+                batch = self.buffer[:self.batch_size]
+                self.buffer = self.buffer[self.batch_size:]
+                status = self.write_batch(batch, status, credentials)
+        return status
+    
+    def persist_contact(self, contact, status, credentials):
+        self.buffer.append(contact["email"], contact["name"])
+        if len(self.buffer) >= self.batch_size:
+            status = self.flush(status, credentials)
+        return status
+    
+    @counts_queries
+    def flush(self, status, credentials):
+        contacts, self.buffer = self.buffer, ContactChunk()
+        if not len(contacts):
+            return status
+        with atomic():
+            return self.write_batch(contacts, status, credentials)
+    
+    def write_batch(self, contacts, status, credentials):
+        owner = credentials["user"]
+        status["total"] += len(contacts)
+        pairs = list(contacts.pairs())
+        emails = list(set([email for email, name in pairs]))
+        # keyed on the lowercased address: a case insensitive collation
+        # (MySQL's default) finds "Ada@example.com" for "ada@example.com"
+        existing = dict(
+            (email.lower(), (email, name))
+            for email, name in TransientContact.objects.filter(
+                owner = owner,
+                email__in = emails,
+            ).values_list("email", "name")
+        )
+        # the contacts are counted one by one, as ModelPersistance counts
+        # them, and written out with the name they end up with
+        names = {}
+        stored = {}
+        new = []
+        for email, name in pairs:
+            if email not in names:
+                found = existing.get(email.lower())
+                if found is None:
+                    names[email] = name
+                    new.append(email)
+                    continue
+                stored[email], names[email] = found
+            if name and name != names[email]:
+                names[email] = name
+                status["updated"] += 1
+            else:
+                status["unchanged"] += 1
+        for email, stored_email in stored.iteritems():
+            if names[email] != existing[email.lower()][1]:
+                update_name(owner, stored_email, names[email])
+        new = [
+            TransientContact(owner=owner, email=email, name=names[email])
+            for email in new
+        ]
+        if new:
+            sid = transaction.savepoint()
+            try:
+                TransientContact.objects.bulk_create(new)
+            except IntegrityError:
+                # another import for the same owner inserted some of these
+                # since we looked; fall back to row by row for this batch
+                transaction.savepoint_rollback(sid)
+                inserted = [obj for obj in new if insert_contact(obj)]
+                status["unchanged"] += len(new) - len(inserted)
+                new = inserted
+            else:
+                transaction.savepoint_commit(sid)
+        status["imported"] += len(new)
+        status["added"] += len(new)
         return status
 
 
 class InMemoryPersistance(BasePersistance):
+    """
+    Keeps the contacts in a dict of email to name instead of the database,
+    for previewing an import before committing it, or for tests::
+        
+        backend = InMemoryPersistance()
+        status = VcardImporter().run({"user": user, "stream": stream}, backend)
+        ... show backend.contacts() ...
+        backend.commit({"user": user})
+        backend.close()
+    
+    Past ``max_contacts`` (``CONTACTS_IMPORT_MEMORY_MAX_CONTACTS``, 100000)
+    further contacts spill over to a SQLite file in the temporary
+    directory, removed by ``close``. The status is the same as for the
+    model backends. The backend may be filled on a runner's thread and
+    read on another; its SQLite connection is shared under a lock.
+    """
+    
+    # contacts handed to the backend at once by commit
+    commit_chunk_size = 500
+    # spilled contacts read from SQLite at once by contacts
+    spill_batch_size = 1000
+    
+    def __init__(self, max_contacts=None):
+        if max_contacts is None:
+            max_contacts = getattr(settings, "CONTACTS_IMPORT_MEMORY_MAX_CONTACTS", 100000)
+        self.max_contacts = max_contacts
+        self.memory = {}
+        self.spill = None
+        self.spill_path = None
+        self.lock = threading.RLock()
+    
+    def persist_chunk(self, contacts, status, credentials):
+        if isinstance(contacts, ContactChunk):
+            pairs = contacts.pairs()
+        else:
+            pairs = ((contact["email"], contact["name"]) for contact in contacts)
+        for email, name in pairs:
+            self.store(email, name, status)
+        return status
     
     def persist_contact(self, contact, status, credentials):
-        # @@@ no longer works (need to conform to status contract which could
-        # be done by adding a new key or emulating a dict and store contacts
-        # that way)
+        self.store(contact["email"], contact["name"], status)
         return status
+    
+    def store(self, email, name, status):
+        with self.lock:
+            self.store_contact(email, name, status)
+    
+    def store_contact(self, email, name, status):
+        status["total"] += 1
+        current = self.get(email)
+        if current is None:
+            if len(self.memory) < self.max_contacts:
+                self.memory[email] = name
+            else:
+                self.execute("INSERT INTO contacts (email, name) VALUES (?, ?)", (email, name))
+            status["imported"] += 1
+            status["added"] += 1
+        elif name and name != current:
+            if email in self.memory:
+                self.memory[email] = name
+            else:
+                self.execute("UPDATE contacts SET name = ? WHERE email = ?", (name, email))
+            status["updated"] += 1
+        else:
+            status["unchanged"] += 1
+    
+    def spilled(self):
+        with self.lock:
+            if self.spill is None:
+                fd, self.spill_path = tempfile.mkstemp(prefix="contacts_import-", suffix=".sqlite")
+                os.close(fd)
+                self.spill = sqlite3.connect(self.spill_path,
+                    isolation_level = None,
+                    check_same_thread = False,
+                )
+                self.spill.execute("PRAGMA synchronous = OFF")
+                self.spill.execute("PRAGMA journal_mode = OFF")
+                self.spill.execute("CREATE TABLE contacts (email TEXT PRIMARY KEY, name TEXT)")
+            return self.spill
+    
+    def execute(self, sql, params=()):
+        """
+        Runs ``sql`` on the spill file and returns the rows.
+        """
+        with self.lock:
+            return self.spilled().execute(sql, params).fetchall()
+    
+    def get(self, email, default=None):
+        """
+        The name stored for ``email``.
+        """
+        name = self.memory.get(email)
+        if name is None and self.spill is not None:
+            rows = self.execute("SELECT name FROM contacts WHERE email = ?", (email,))
+            if rows:
+                name = rows[0][0]
+        if name is None:
+            return default
+        return name
+    
+    def __len__(self):
+        count = len(self.memory)
+        if self.spill is not None:
+            count += self.execute("SELECT COUNT(*) FROM contacts")[0][0]
+        return count
+    
+    def __contains__(self, email):
+        return self.get(email) is not None
+    
+    def contacts(self):
+        """
+        Yields every stored contact as an ``ImportedContact``.
+        """
+        for email, name in self.memory.iteritems():
+            yield ImportedContact(email, name)
+        if self.spill is None:
+            return
+        # a batch at a time, so the lock isn't held while the caller works
+        last = 0
+        while True:
+            rows = self.execute(
+                "SELECT rowid, email, name FROM contacts WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last, self.spill_batch_size)
+            )
+            for last, email, name in rows:
+                yield ImportedContact(email, name)
+            if len(rows) < self.spill_batch_size:
+                return
+    
+    def commit(self, credentials, persistance=None):
+        """
+        Hands the stored contacts over to ``persistance`` (by default a
+        ``BulkModelPersistance``) and returns its status.
+        """
+        if persistance is None:
+            persistance = BulkModelPersistance()
+        persistance.open(credentials)
+        status = persistance.default_status()
+        for chunk in chunked_contacts(self.contacts(), self.commit_chunk_size):
+            status = persistance.persist_chunk(chunk, status, credentials)
+        status = persistance.flush(status, credentials)
+        return persistance.finalize(status, credentials)
+    
+    def close(self):
+        self.memory = {}
+        with self.lock:
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+                os.remove(self.spill_path)
+    
+    def __del__(self):
+        # don't leave the spill file behind when nobody closed the backend
+        if self.spill is not None:
+            self.close()
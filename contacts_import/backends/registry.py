@@ -0,0 +1,66 @@
+"""
+The importers known to the app, by provider name. The registry drives the
+generic ``import_from`` and ``import_callback`` views and the Celery task
+registration; what those need to know of a provider is on its importer:
+``login_url``, ``login_callback``, ``credential_keys`` and ``form``.
+
+Importers are listed by dotted path and only imported the first time they
+are asked for, so a process that never imports from Google never loads
+``gdata`` and one that never imports from Yahoo never loads ``oauth2``.
+
+Settings:
+
+    CONTACTS_IMPORT_IMPORTERS  maps further provider names to importer
+                               paths, or a built-in provider to None to
+                               turn it off ({})
+"""
+
+import threading
+
+from django.conf import settings
+
+
+__all__ = ["IMPORTERS", "get_importer", "providers"]
+
+
+IMPORTERS = {
+    "vcard": "contacts_import.backends.importers.VcardImporter",
+    "email_list": "contacts_import.backends.importers.EmailListImporter",
+    "csv": "contacts_import.backends.importers.CsvImporter",
+    "ldif": "contacts_import.backends.importers.LdifImporter",
+    "google": "contacts_import.backends.importers.GoogleImporter",
+    "yahoo": "contacts_import.backends.importers.YahooImporter",
+}
+
+_importers = {}
+_lock = threading.Lock()
+
+
+def importer_paths():
+    paths = dict(IMPORTERS)
+    paths.update(getattr(settings, "CONTACTS_IMPORT_IMPORTERS", {}))
+    return dict((name, path) for name, path in paths.iteritems() if path)
+
+
+def providers():
+    return sorted(importer_paths())
+
+
+def get_importer(provider):
+    """
+    The importer class registered for ``provider``, imported on first use.
+    """
+    # the settings may have changed since, providers be turned off
+    paths = importer_paths()
+    if provider not in paths:
+        raise KeyError("Unknown contacts provider '%s'" % provider)
+    path = paths[provider]
+    try:
+        return _importers[path]
+    except KeyError:
+        pass
+    from contacts_import.settings import import_attr
+    with _lock:
+        if path not in _importers:
+            _importers[path] = import_attr(path)
+    return _importers[path]
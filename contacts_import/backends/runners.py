@@ -1,11 +1,34 @@
+import shutil
 import sys
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.db import connection
+
+from contacts_import.settings import get_default_persistance
+from contacts_import.utils.pool import PoolFull, get_pool
+
+
+THREAD_POOL_WORKERS = getattr(settings, "CONTACTS_IMPORT_THREAD_POOL_WORKERS", 2)
+THREAD_POOL_QUEUE_SIZE = getattr(settings, "CONTACTS_IMPORT_THREAD_POOL_QUEUE_SIZE", 10)
+# uploads smaller than this are kept in memory until a worker reads them
+SPOOL_MAX_SIZE = getattr(settings, "CONTACTS_IMPORT_SPOOL_MAX_SIZE", 1024 * 1024)
+# persist the chunks of asynchronous imports on separate tasks
+FAN_OUT = getattr(settings, "CONTACTS_IMPORT_FAN_OUT", False)
+GEVENT_POOL_SIZE = getattr(settings, "CONTACTS_IMPORT_GEVENT_POOL_SIZE", 200)
 
 
 class BaseRunner(object):
+    # imports a process may run at once, which sizes the HTTP pool
+    concurrency = 1
+    
     def __init__(self, importer, persistance=None, **credentials):
-        from contacts_import.settings import DEFAULT_PERSISTANCE
         if persistance is None:
-            persistance = DEFAULT_PERSISTANCE
+            persistance = get_default_persistance()
         self.importer = importer
         self.persistance = persistance
         self.credentials = credentials
@@ -30,10 +53,183 @@ class SynchronousResult(object):
 class SynchronousRunner(BaseRunner):
     def import_contacts(self):
         return SynchronousResult(
-            self.importer().run(self.credentials, self.persistance())
+            self.importer().run(self.credentials, self.persistance(),
+                dispatched = time.time(),
+            )
         )
 
 
 class AsyncRunner(BaseRunner):
     def import_contacts(self):
-        return self.importer.delay(self.credentials, self.persistance())
+        from contacts_import.backends.importers import get_task
+        from contacts_import.progress import mark_pending
+        from contacts_import.utils.staging import stage
+        # uploads go through storage rather than the broker
+        result = get_task(self.importer).delay(stage(self.credentials), self.persistance(),
+            dispatched = time.time(),
+            fan_out = FAN_OUT,
+        )
+        mark_pending(result.task_id, self.credentials["user"])
+        return result
+
+
+
+class ThreadPoolResult(object):
+    """
+    The result of an import running on a ``ThreadPoolRunner`` thread.
+    """
+    
+    def __init__(self, future, task_id):
+        self.future = future
+        self.task_id = task_id
+    
+    def ready(self):
+        return self.future.done()
+    
+    @property
+    def status(self):
+        if not self.future.done():
+            return "PENDING"
+        if self.future.exception() is not None:
+            return "FAILURE"
+        return "DONE"
+    
+    @property
+    def result(self):
+        if self.status != "DONE":
+            return None
+        return self.future.result()
+
+
+class ThreadPoolRunner(BaseRunner):
+    """
+    Runs imports on a small pool of threads in the web process, so the
+    request returns straight away without a Celery broker. Progress is
+    reported through the cache as for ``AsyncRunner``, which means the
+    cache must be shared by the threads (any backend but ``dummy``).
+    
+    When ``CONTACTS_IMPORT_THREAD_POOL_QUEUE_SIZE`` imports are already
+    waiting for one of the ``CONTACTS_IMPORT_THREAD_POOL_WORKERS`` threads
+    the import runs synchronously instead.
+    """
+    
+    concurrency = THREAD_POOL_WORKERS
+    
+    def import_contacts(self):
+        from contacts_import.progress import mark_pending
+        credentials = self.spool_stream(self.credentials)
+        task_id = uuid.uuid4().hex
+        pool = get_pool("runner", THREAD_POOL_WORKERS, THREAD_POOL_QUEUE_SIZE)
+        mark_pending(task_id, credentials["user"])
+        try:
+            future = pool.submit(self.run, credentials, self.persistance(), task_id, time.time())
+        except PoolFull:
+            return SynchronousResult(self.run(credentials, self.persistance(), task_id, time.time()))
+        return ThreadPoolResult(future, task_id)
+    
+    def run(self, credentials, persistance, task_id, dispatched):
+        try:
+            return self.importer().run(credentials, persistance,
+                task_id = task_id,
+                dispatched = dispatched,
+            )
+        finally:
+            # each thread gets its own connection; don't leave it open
+            connection.close()
+    
+    def spool_stream(self, credentials):
+        """
+        Copies an uploaded file, which goes away with the request, to a
+        temporary file the worker thread can read.
+        """
+        stream = credentials.get("stream")
+        if not hasattr(stream, "read"):
+            return credentials
+        spool = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
+        if hasattr(stream, "chunks"):
+            for chunk in stream.chunks():
+                spool.write(chunk)
+        else:
+            shutil.copyfileobj(stream, spool)
+        size = spool.tell()
+        spool.seek(0)
+        credentials = dict(credentials)
+        credentials["stream"] = File(spool)
+        credentials["stream"].size = size
+        return credentials
+
+
+
+class GreenletResult(object):
+    """
+    The result of an import running on a ``GeventRunner`` greenlet.
+    """
+    
+    def __init__(self, greenlet, task_id):
+        self.greenlet = greenlet
+        self.task_id = task_id
+    
+    def ready(self):
+        return self.greenlet.ready()
+    
+    @property
+    def status(self):
+        if not self.greenlet.ready():
+            return "PENDING"
+        if not self.greenlet.successful():
+            return "FAILURE"
+        return "DONE"
+    
+    @property
+    def result(self):
+        if self.status != "DONE":
+            return None
+        return self.greenlet.value
+
+
+_gevent_pool = None
+
+
+class GeventRunner(ThreadPoolRunner):
+    """
+    Runs each import on a greenlet, so one process can wait on hundreds of
+    provider imports at once. The importers are unchanged: their blocking
+    httplib2 calls yield to other greenlets because the process is
+    expected to run with the standard library monkey patched (gunicorn's
+    gevent worker or ``gevent.monkey.patch_all()`` before Django starts).
+    
+    At most ``CONTACTS_IMPORT_GEVENT_POOL_SIZE`` imports run at once; past
+    that the import runs synchronously. Unless
+    ``CONTACTS_IMPORT_HTTP_MAX_PER_HOST`` says otherwise, the HTTP pool
+    allows as many connections per provider host, so the imports don't
+    queue up for a connection.
+    """
+    
+    concurrency = GEVENT_POOL_SIZE
+    
+    def __init__(self, *args, **kwargs):
+        # imported here: a process that uses this runner has gevent loaded
+        # already, any other process should not pay for it
+        try:
+            import gevent.monkey
+        except ImportError:
+            raise ImproperlyConfigured("GeventRunner requires gevent")
+        if not gevent.monkey.is_module_patched("socket"):
+            raise ImproperlyConfigured(
+                "GeventRunner requires the socket module to be monkey patched"
+            )
+        super(GeventRunner, self).__init__(*args, **kwargs)
+    
+    def import_contacts(self):
+        global _gevent_pool
+        from contacts_import.progress import mark_pending
+        if _gevent_pool is None:
+            import gevent.pool
+            _gevent_pool = gevent.pool.Pool(GEVENT_POOL_SIZE)
+        credentials = self.spool_stream(self.credentials)
+        task_id = uuid.uuid4().hex
+        mark_pending(task_id, credentials["user"])
+        if _gevent_pool.full():
+            return SynchronousResult(self.run(credentials, self.persistance(), task_id, time.time()))
+        greenlet = _gevent_pool.spawn(self.run, credentials, self.persistance(), task_id, time.time())
+        return GreenletResult(greenlet, task_id)
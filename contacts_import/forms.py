@@ -1,26 +1,85 @@
-import re
+import csv
 
 from django import forms
-from django.core.validators import validate_email
 from django.utils.translation import ugettext as _
 
-from .backends.importers import VcardImporter, EmailListImporter
-from .backends.runners import SynchronousRunner
+from .backends.registry import get_importer
+from .utils.csvfile import read_columns
+from .utils.emails import iter_emails
+from .utils.ldif import iter_ldif_contacts
 
 class VcardImportForm(forms.Form):
     vcard_file = forms.FileField(label=_("vCard File"))
     
-    def save(self, user, runner_class=SynchronousRunner):
-        importer = runner_class(VcardImporter,
+    def save(self, user, runner_class=None):
+        if runner_class is None:
+            from .backends.runners import SynchronousRunner as runner_class
+        importer = runner_class(get_importer("vcard"),
                                 user = user,
                                 stream = self.cleaned_data["vcard_file"]
                                 )
         return importer.import_contacts()
 
 
+class CsvImportForm(forms.Form):
+    """
+    Form for importing an address book exported as CSV. Only the first
+    lines are read here, to make sure there are addresses to import.
+    """
+    csv_file = forms.FileField(label=_("CSV File"))
+    
+    def clean_csv_file(self):
+        csv_file = self.cleaned_data["csv_file"]
+        try:
+            columns, rows = read_columns(csv_file)
+        except csv.Error:
+            raise forms.ValidationError(_("This file could not be read as CSV."))
+        finally:
+            csv_file.seek(0)
+        if columns is None:
+            raise forms.ValidationError(_("No column of email addresses found."))
+        return csv_file
+    
+    def save(self, user, runner_class=None):
+        if runner_class is None:
+            from .backends.runners import SynchronousRunner as runner_class
+        importer = runner_class(get_importer("csv"),
+                                user = user,
+                                stream = self.cleaned_data["csv_file"]
+                                )
+        return importer.import_contacts()
+
+
+class LdifImportForm(forms.Form):
+    """
+    Form for importing an address book exported as LDIF. The file is read
+    up to the first entry with an address, to make sure there is one.
+    """
+    ldif_file = forms.FileField(label=_("LDIF File"))
+    
+    def clean_ldif_file(self):
+        ldif_file = self.cleaned_data["ldif_file"]
+        contact = next(iter_ldif_contacts(ldif_file), None)
+        ldif_file.seek(0)
+        if contact is None:
+            raise forms.ValidationError(_("No entry with an email address found."))
+        return ldif_file
+    
+    def save(self, user, runner_class=None):
+        if runner_class is None:
+            from .backends.runners import SynchronousRunner as runner_class
+        importer = runner_class(get_importer("ldif"),
+                                user = user,
+                                stream = self.cleaned_data["ldif_file"]
+                                )
+        return importer.import_contacts()
+
+
 class EmailListImportForm(forms.Form):
     """
-    Form for importing a list of comma-separated email adresses
+    Form for importing a list of email adresses, separated by commas,
+    semicolons or new lines. ``rejected`` lists the ``(line, token, reason)``
+    of everything that was skipped.
     """
     emails = forms.CharField(label=_("email adresses"),
                              widget=forms.Textarea,
@@ -29,18 +88,21 @@ class EmailListImportForm(forms.Form):
     def clean_emails(self):
         emails = self.cleaned_data.get('emails')
 
-        # Remove whitespaces
-        emails = re.sub(r'\s', '', emails)
-       
-        # Split emails to get a list and validate them against the
-        # django email validator
-        email_list = emails.split(",")
-        [validate_email(email) for email in email_list]
+        # Only count the valid addresses here; the importer parses the
+        # text again as it goes
+        self.rejected = []
+        self.valid_count = 0
+        for contact in iter_emails(emails, self.rejected):
+            self.valid_count += 1
+        if not self.valid_count:
+            raise forms.ValidationError(_("No valid email address found."))
 
-        return email_list
+        return emails
 
-    def save(self, user, runner_class=SynchronousRunner):
-        importer = runner_class(EmailListImporter,
+    def save(self, user, runner_class=None):
+        if runner_class is None:
+            from .backends.runners import SynchronousRunner as runner_class
+        importer = runner_class(get_importer("email_list"),
                                 user = user,
                                 stream = self.cleaned_data.get('emails')
                                 )
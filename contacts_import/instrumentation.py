@@ -0,0 +1,169 @@
+"""
+Per-import measurements. ``BaseImporter.run`` fills in an ``ImportStats``
+while it works, returns it under the ``"stats"`` key of the status and
+hands it to every hook listed in ``CONTACTS_IMPORT_STATS_HOOKS`` as well
+as to the ``contacts_import.signals.import_finished`` signal.
+
+A hook is any callable taking ``(importer, stats, status, credentials)``
+where ``stats`` is the dict produced by ``ImportStats.as_dict``::
+
+    CONTACTS_IMPORT_STATS_HOOKS = [
+        "contacts_import.instrumentation.log_stats",
+        "myproject.metrics.contacts_import_statsd",
+    ]
+
+and, in ``myproject/metrics.py``::
+
+    contacts_import_statsd = StatsdHook(statsd_client, "contacts_import")
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from contacts_import.signals import import_finished
+
+
+logger = logging.getLogger("contacts_import")
+
+
+PHASES = ("fetch", "parse", "persist")
+
+
+class ImportStats(object):
+    """
+    Timings are in seconds. ``fetch`` is the time the import spent waiting
+    on the provider, ``parse`` the time spent turning what it got back into
+    contacts and ``persist`` the time spent in the persistance backend.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.queued = 0.0
+        self.timings = dict.fromkeys(PHASES, 0.0)
+        self.bytes = 0
+        self.queries = 0
+        self.contacts = 0
+        self.merged = 0
+    
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.timings[phase] += seconds
+    
+    def add_bytes(self, count):
+        with self.lock:
+            self.bytes += count
+    
+    def timer(self, phase):
+        return _Timer(self, phase)
+    
+    def finish(self):
+        self.finished = time.time()
+    
+    def as_dict(self):
+        elapsed = (self.finished or time.time()) - self.started
+        stats = dict(self.timings)
+        stats.update({
+            "total": elapsed,
+            "queued": self.queued,
+            "bytes": self.bytes,
+            "queries": self.queries,
+            "contacts": self.contacts,
+            "merged": self.merged,
+            "rate": elapsed and self.contacts / elapsed or 0.0,
+        })
+        return stats
+
+
+class _Timer(object):
+    
+    def __init__(self, stats, phase):
+        self.stats = stats
+        self.phase = phase
+    
+    def __enter__(self):
+        self.start = time.time()
+    
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.phase, time.time() - self.start)
+
+
+def timed(iterable, stats, phase):
+    """
+    Passes the items of ``iterable`` through, adding the time spent
+    waiting for each of them to ``phase``.
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = iterator.next()
+        except StopIteration:
+            return
+        finally:
+            stats.add_time(phase, time.time() - start)
+        yield item
+
+
+_hooks = None
+
+
+def get_hooks():
+    global _hooks
+    if _hooks is None:
+        from contacts_import.settings import import_attr
+        _hooks = [
+            import_attr(path)
+            for path in getattr(settings, "CONTACTS_IMPORT_STATS_HOOKS", [])
+        ]
+    return _hooks
+
+
+def emit(importer, stats, status, credentials):
+    import_finished.send(
+        sender = importer.__class__,
+        stats = stats,
+        status = status,
+        user = credentials.get("user"),
+    )
+    for hook in get_hooks():
+        try:
+            hook(importer, stats, status, credentials)
+        except Exception:
+            # metrics must never break an import
+            logger.exception("contacts import stats hook %r failed" % hook)
+
+
+def log_stats(importer, stats, status, credentials):
+    logger.info(
+        "%s: %d contacts (%d imported) in %.2fs [fetch %.2fs, parse %.2fs, "
+        "persist %.2fs] %d bytes, %d queries, %.1f contacts/s" % (
+            importer.__class__.__name__, stats["contacts"], status["imported"],
+            stats["total"], stats["fetch"], stats["parse"], stats["persist"],
+            stats["bytes"], stats["queries"], stats["rate"],
+        )
+    )
+
+
+class StatsdHook(object):
+    """
+    Sends the stats to anything with a StatsD style ``timing(name, ms)`` and
+    ``incr(name, count)`` interface.
+    """
+    
+    def __init__(self, client, prefix="contacts_import"):
+        self.client = client
+        self.prefix = prefix
+    
+    def __call__(self, importer, stats, status, credentials):
+        prefix = "%s.%s" % (self.prefix, importer.__class__.__name__.lower())
+        for phase in PHASES + ("total", "queued"):
+            self.client.timing("%s.%s" % (prefix, phase), int(stats[phase] * 1000))
+        self.client.incr("%s.contacts" % prefix, stats["contacts"])
+        self.client.incr("%s.imported" % prefix, status["imported"])
+        self.client.incr("%s.bytes" % prefix, stats["bytes"])
+        self.client.incr("%s.queries" % prefix, stats["queries"])
@@ -0,0 +1,293 @@
+"""
+Runs every importer against every persistance backend on synthetic data
+and reports throughput, peak memory and query counts::
+
+    ./manage.py benchmark_contacts_import --sizes=1000,10000 --output=bench.json
+
+Provider HTTP calls are answered in process, so no network access or
+provider credentials are needed. Everything runs against a throwaway test
+database. Keep the JSON output of two commits around to compare them.
+"""
+
+import platform
+import random
+import resource
+import threading
+import time
+import urlparse
+
+from optparse import make_option
+from StringIO import StringIO
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import simplejson as json
+
+from django.contrib.auth.models import User
+
+from contacts_import.backends import importers
+from contacts_import.backends.runners import SynchronousRunner
+from contacts_import.models import TransientContact
+from contacts_import.settings import import_attr
+from contacts_import.utils import httppool
+
+
+DEFAULT_SIZES = "1000,10000,100000"
+DEFAULT_IMPORTERS = "vcard,email_list,google,yahoo"
+DEFAULT_BACKENDS = ",".join([
+    "contacts_import.backends.persistance.ModelPersistance",
+    "contacts_import.backends.persistance.BulkModelPersistance",
+    "contacts_import.backends.persistance.InMemoryPersistance",
+])
+
+FIRST_NAMES = ["Ada", "Alan", "Barbara", "Dennis", "Donald", "Edsger", "Grace", "Guido", "John", "Ken"]
+LAST_NAMES = ["Hopper", "Knuth", "Liskov", "Lovelace", "McCarthy", "Ritchie", "Rossum", "Thompson", "Turing"]
+DOMAINS = ["example.com", "example.org", "example.net", "mail.example.com"]
+
+
+def generate_people(size, seed=0):
+    """
+    ``size`` (name, email) pairs; about 1 in 20 emails is repeated, as
+    real address books have duplicates.
+    """
+    rnd = random.Random(seed)
+    people = []
+    for i in xrange(size):
+        if i and rnd.random() < 0.05:
+            people.append((people[rnd.randrange(i)][0], people[rnd.randrange(i)][1]))
+            continue
+        first, last = rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+        email = "%s.%s.%d@%s" % (first.lower(), last.lower(), i, rnd.choice(DOMAINS))
+        people.append(("%s %s" % (first, last), email))
+    return people
+
+
+def generate_vcard(people):
+    # a small fake photo so the parser has binary data to skip
+    photo = "\r\n ".join(["QUJDREVGR0hJSktMTU5PUFFSU1RVVldYWVo" * 2] * 20)
+    out = StringIO()
+    for name, email in people:
+        first, last = name.split(" ", 1)
+        out.write(
+            "BEGIN:VCARD\r\nVERSION:3.0\r\n"
+            "N:%s;%s;;;\r\nFN:%s\r\n"
+            "EMAIL;TYPE=INTERNET:%s\r\n"
+            "TEL;TYPE=CELL:+1 555 0100\r\n"
+            "PHOTO;ENCODING=b;TYPE=JPEG:%s\r\n"
+            "END:VCARD\r\n" % (last, first, name, email, photo)
+        )
+    return out.getvalue()
+
+
+class Response(dict):
+    
+    def __init__(self, status):
+        super(Response, self).__init__()
+        self.status = status
+
+
+class StubProviders(object):
+    """
+    Stands in for ``httppool.request``, answering Google feed and Yahoo
+    contacts API calls from pre-serialized pages.
+    """
+    
+    def __init__(self, people):
+        self.people = people
+    
+    def __call__(self, url, method="GET", body=None, headers=None, cache_scope=None):
+        url = urlparse.urlsplit(url)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path.startswith("/m8/feeds/"):
+            return self.google(query)
+        if url.path == "/v1/me/guid":
+            return Response(200), json.dumps({"guid": {"value": "BENCH"}})
+        if url.path.startswith("/v1/user/"):
+            return self.yahoo(query)
+        return Response(404), ""
+    
+    def google(self, query):
+        start = int(query["start-index"])
+        count = int(query["max-results"])
+        entries = [
+            {"title": {"$t": name}, "gd$email": [{"address": email, "primary": "true"}]}
+            for name, email in self.people[start-1:start-1+count]
+        ]
+        return Response(200), json.dumps({"feed": {
+            "entry": entries,
+            "openSearch$totalResults": {"$t": str(len(self.people))},
+            "openSearch$startIndex": {"$t": str(start)},
+            "openSearch$itemsPerPage": {"$t": str(count)},
+            "link": [],
+        }})
+    
+    def yahoo(self, query):
+        start = int(query["start"])
+        count = int(query["count"])
+        contacts = []
+        for name, email in self.people[start:start+count]:
+            first, last = name.split(" ", 1)
+            contacts.append({"fields": [
+                {"type": "email", "value": email},
+                {"type": "name", "value": {"givenName": first, "familyName": last}},
+            ]})
+        return Response(200), json.dumps({"contacts": {
+            "start": start,
+            "count": len(contacts),
+            "total": len(self.people),
+            "contact": contacts,
+        }})
+
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the resident set size while a benchmark runs; the peak is
+    reported relative to the size before it started.
+    """
+    
+    interval = 0.01
+    
+    def __init__(self):
+        super(MemorySampler, self).__init__()
+        self.daemon = True
+        self.running = True
+        self.baseline = self.peak = current_rss()
+    
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, current_rss())
+            time.sleep(self.interval)
+    
+    def stop(self):
+        self.running = False
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak - self.baseline
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # no procfs; fall back to the (process wide) peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the contact importers and persistance backends"
+    option_list = BaseCommand.option_list + (
+        make_option("--sizes", default=DEFAULT_SIZES,
+            help="Comma separated address book sizes [%s]" % DEFAULT_SIZES),
+        make_option("--importers", default=DEFAULT_IMPORTERS,
+            help="Comma separated importers to run [%s]" % DEFAULT_IMPORTERS),
+        make_option("--backends", default=DEFAULT_BACKENDS,
+            help="Comma separated persistance backends to run"),
+        make_option("--output", default=None,
+            help="Write the results as JSON to this file"),
+        make_option("--label", default="",
+            help="Free form label stored with the results, e.g. a commit id"),
+    )
+    
+    def handle(self, **options):
+        sizes = [int(size) for size in options["sizes"].split(",") if size]
+        names = [name for name in options["importers"].split(",") if name]
+        for name in names:
+            if name not in self.importers():
+                raise CommandError("Unknown importer '%s'" % name)
+        backends = [import_attr(path) for path in options["backends"].split(",") if path]
+        verbosity = int(options.get("verbosity", 1))
+        
+        old_name = settings.DATABASES["default"]["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        original_request = httppool.request
+        results = []
+        try:
+            user = User.objects.create_user("benchmark", "benchmark@example.com")
+            for size in sizes:
+                people = generate_people(size)
+                payloads = self.payloads(people)
+                httppool.request = StubProviders(people)
+                for name in names:
+                    for backend in backends:
+                        result = self.run_one(user, name, backend, size, payloads[name])
+                        results.append(result)
+                        if verbosity:
+                            self.stdout.write(self.format_result(result) + "\n")
+        finally:
+            httppool.request = original_request
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump({
+                    "label": options["label"],
+                    "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "python": platform.python_version(),
+                    "django": django.get_version(),
+                    "database": connection.vendor,
+                    "results": results,
+                }, output, indent=2, sort_keys=True)
+    
+    def importers(self):
+        return {
+            "vcard": importers.VcardImporter,
+            "email_list": importers.EmailListImporter,
+            "google": importers.GoogleImporter,
+            "yahoo": importers.YahooImporter,
+        }
+    
+    def payloads(self, people):
+        return {
+            "vcard": generate_vcard(people),
+            "email_list": "\n".join([email for name, email in people]),
+            "google": None,
+            "yahoo": None,
+        }
+    
+    def credentials(self, name, payload):
+        if name == "vcard":
+            return {"stream": StringIO(payload)}
+        if name == "email_list":
+            return {"stream": payload}
+        if name == "google":
+            return {"authsub_token": "benchmark"}
+        return {"yahoo_token": "oauth_token=benchmark&oauth_token_secret=benchmark"}
+    
+    def run_one(self, user, name, backend, size, payload):
+        TransientContact.objects.delete_for(user)
+        runner = SynchronousRunner(self.importers()[name], backend,
+            user = user,
+            **self.credentials(name, payload)
+        )
+        oauth_settings = {"yahoo": {"keys": {"KEY": "benchmark", "SECRET": "benchmark"}}}
+        sampler = MemorySampler()
+        sampler.start()
+        start = time.time()
+        with override_settings(OAUTH_CONSUMER_SETTINGS=oauth_settings,
+                               CONTACTS_IMPORT_YAHOO_CLIENT="oauth_consumer"):
+            status = runner.import_contacts().result
+        elapsed = time.time() - start
+        peak = sampler.stop()
+        stats = status.pop("stats")
+        return {
+            "importer": name,
+            "backend": "%s.%s" % (backend.__module__, backend.__name__),
+            "size": size,
+            "seconds": elapsed,
+            "contacts_per_second": elapsed and size / elapsed or 0.0,
+            "peak_memory": peak,
+            "queries": stats["queries"],
+            "status": status,
+            "stats": stats,
+        }
+    
+    def format_result(self, result):
+        return "%-10s %-22s %7d  %8.3fs  %9.0f/s  %7.1fMB  %7d queries" % (
+            result["importer"], result["backend"].rsplit(".", 1)[-1],
+            result["size"], result["seconds"], result["contacts_per_second"],
+            result["peak_memory"] / (1024.0 * 1024), result["queries"],
+        )
@@ -0,0 +1,34 @@
+"""
+Deletes the transient contacts of imports that were never finished::
+
+    ./manage.py purge_transient_contacts --age=86400
+
+Run it from cron, or enable ``contacts_import.tasks.PurgeTransientContactsTask``
+when celery is in use.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from contacts_import.models import TransientContact, PURGE_AGE, DELETE_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Deletes transient contacts left behind by abandoned imports"
+    option_list = BaseCommand.option_list + (
+        make_option("--age", type="int", default=PURGE_AGE,
+            help="Purge contacts imported more than this many seconds ago [%d]" % PURGE_AGE),
+        make_option("--batch-size", type="int", default=DELETE_BATCH_SIZE,
+            help="Rows deleted per statement [%d]" % DELETE_BATCH_SIZE),
+        make_option("--pause", type="float", default=0,
+            help="Seconds to sleep between two batches [0]"),
+    )
+    
+    def handle(self, **options):
+        deleted = TransientContact.objects.purge(options["age"],
+            batch_size = options["batch_size"],
+            pause = options["pause"],
+        )
+        if int(options.get("verbosity", 1)):
+            self.stdout.write("Deleted %d transient contacts\n" % deleted)
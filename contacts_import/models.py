@@ -1,7 +1,115 @@
-from django.db import models
+import time
+
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, models
+from django.utils import timezone
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    from django.db.transaction import commit_on_success as atomic
 
 from django.contrib.auth.models import User
 
+from contacts_import.paginator import keyset_page
+
+
+COUNT_TIMEOUT = getattr(settings, "CONTACTS_IMPORT_COUNT_TIMEOUT", 60 * 60)
+DELETE_BATCH_SIZE = getattr(settings, "CONTACTS_IMPORT_DELETE_BATCH_SIZE", 1000)
+# contacts older than this (in seconds) belong to abandoned imports
+PURGE_AGE = getattr(settings, "CONTACTS_IMPORT_PURGE_AGE", 24 * 60 * 60)
+
+
+class TransientContactManager(models.Manager):
+    
+    def count_key(self, owner):
+        return "contacts_import:count:%s" % owner.pk
+    
+    def count_for(self, owner):
+        """
+        Number of contacts imported by ``owner``, cached until the next
+        import finishes or the contacts are deleted.
+        """
+        key = self.count_key(owner)
+        count = cache.get(key)
+        if count is None:
+            count = self.filter(owner=owner).count()
+            cache.set(key, count, COUNT_TIMEOUT)
+        return count
+    
+    def invalidate_count(self, owner):
+        cache.delete(self.count_key(owner))
+    
+    def _delete_batches(self, where, params, batch_size, pause=0):
+        """
+        Deletes the rows matching ``where`` with plain ``DELETE`` statements
+        of at most ``batch_size`` rows each, committed one at a time so no
+        lock is held for long. Nothing refers to transient contacts, so
+        Django's collector (which loads every row first) is not needed.
+        Returns the number of rows deleted and the owners they belonged to.
+        """
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        select = "SELECT id, owner_id FROM %s WHERE %s ORDER BY id LIMIT %d" % (
+            table, where, batch_size
+        )
+        delete = "DELETE FROM %s WHERE %s AND id <= %%s" % (table, where)
+        deleted = 0
+        owners = set()
+        while True:
+            with atomic():
+                cursor = connection.cursor()
+                cursor.execute(select, params)
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                cursor.execute(delete, params + [rows[-1][0]])
+            deleted += len(rows)
+            owners.update(owner_id for pk, owner_id in rows)
+            if len(rows) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+        return deleted, owners
+    
+    def delete_for(self, owner, batch_size=DELETE_BATCH_SIZE):
+        """
+        Deletes every contact imported by ``owner``, once they picked the
+        ones they want or gave up on the import.
+        """
+        deleted, owners = self._delete_batches("owner_id = %s", [owner.pk], batch_size)
+        self.invalidate_count(owner)
+        # an incremental import only lists what changed since the last one;
+        # the contacts deleted here, picked or skipped, must be listed again
+        ImportSyncState.objects.filter(owner=owner).delete()
+        return deleted
+    
+    def purge(self, age=PURGE_AGE, batch_size=DELETE_BATCH_SIZE, pause=0):
+        """
+        Deletes the contacts imported more than ``age`` seconds ago, that
+        is abandoned imports. Returns the number of contacts deleted.
+        """
+        cutoff = timezone.now() - timedelta(seconds=age)
+        deleted, owners = self._delete_batches("created < %s",
+            [connection.ops.value_to_db_datetime(cutoff)], batch_size, pause
+        )
+        for owner_id in owners:
+            cache.delete(self.count_key(User(pk=owner_id)))
+        # what those imports fetched never reached the callback; the next
+        # import must start over
+        ImportSyncState.objects.filter(owner__in=owners).delete()
+        return deleted
+    
+    def page_for(self, owner, per_page, after=None, before=None, number=None):
+        return keyset_page(self.filter(owner=owner), per_page,
+            after = after,
+            before = before,
+            count = self.count_for(owner),
+            number = number,
+        )
+
 
 class TransientContact(models.Model):
     # The user who created this contact
@@ -9,6 +117,53 @@ class TransientContact(models.Model):
     
     name = models.CharField(max_length=100, blank=True)
     email = models.EmailField()
+    created = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
+    
+    objects = TransientContactManager()
+    
+    class Meta:
+        ordering = ["id"]
+        # the unique index doubles as the (owner, email) lookup index used
+        # by the persistance backends; (owner, id) serves paging
+        unique_together = [("owner", "email")]
+        if django.VERSION >= (1, 5):
+            index_together = [("owner", "id")]
     
     def __unicode__(self):
         return "%s (%s's contact)" % (self.email, self.owner)
+
+
+
+class ImportSyncStateManager(models.Manager):
+    
+    def get_for(self, owner, provider):
+        """
+        The sync state of ``owner``'s last import from ``provider``; a new,
+        unsaved one if there is none.
+        """
+        try:
+            return self.get(owner=owner, provider=provider)
+        except self.model.DoesNotExist:
+            return self.model(owner=owner, provider=provider)
+
+
+class ImportSyncState(models.Model):
+    """
+    What a provider told us at the end of the last import, so that the next
+    one only asks for what changed since.
+    """
+    owner = models.ForeignKey(User, related_name="contacts_import_sync_states")
+    provider = models.CharField(max_length=50)
+    
+    # Google's feed updated time, Yahoo's revision
+    token = models.CharField(max_length=255, blank=True)
+    etag = models.CharField(max_length=255, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+    
+    objects = ImportSyncStateManager()
+    
+    class Meta:
+        unique_together = [("owner", "provider")]
+    
+    def __unicode__(self):
+        return "%s sync state of %s" % (self.provider, self.owner)
@@ -1,4 +1,3 @@
-import httplib2
 import logging
 import socket
 
@@ -9,6 +8,7 @@ from django.utils import simplejson as json
 
 import oauth2 as oauth
 
+from contacts_import.utils import httppool
 from contacts_import.utils.anyetree import etree
 
 
@@ -21,8 +21,13 @@ class ServiceFail(Exception):
 
 class oAuthConsumer(object):
     
-    def __init__(self, service):
+    # bytes received by this consumer so far
+    received = 0
+    
+    def __init__(self, service, cache_scope=None):
         self.service = service
+        # GET responses may be cached under this, see utils.httpcache
+        self.cache_scope = cache_scope
         self.signature_method = oauth.SignatureMethod_HMAC_SHA1()
         self.consumer = oauth.Consumer(self.key, self.secret)
     
@@ -159,10 +164,14 @@ class oAuthConsumer(object):
     
     def _oauth_response(self, request):
         # @@@ not sure if this will work everywhere. need to explore more.
-        http = httplib2.Http()
         headers = {}
         headers.update(request.to_header())
-        ret = http.request(request.url, request.method, headers=headers)
+        ret = httppool.request(request.url, request.method,
+            headers = headers,
+            cache_scope = self.cache_scope,
+        )
         response, content = ret
+        if not getattr(response, "fromcache", False):
+            self.received += len(content)
         logger.debug(repr(ret))
         return content
@@ -0,0 +1,84 @@
+"""
+Keyset ("seek") pagination. Instead of ``OFFSET n`` each page asks for the
+rows after (or before) the last primary key shown, which an index on
+``(owner, id)`` answers in constant time however deep the page is.
+
+Pages still have the ``number`` of Django's ``Page``, carried along in the
+``page`` parameter next to ``after`` and ``before``, so templates showing
+"page 3" keep working; a ``?page=<n>`` link without either is served with
+an ``OFFSET``, as before.
+"""
+
+
+class KeysetPage(object):
+    
+    def __init__(self, object_list, has_next, has_previous, count, number=1):
+        self.object_list = object_list
+        self.count = count
+        self.number = number
+        self._has_next = has_next
+        self._has_previous = has_previous
+    
+    def __iter__(self):
+        return iter(self.object_list)
+    
+    def __len__(self):
+        return len(self.object_list)
+    
+    def has_next(self):
+        return self._has_next
+    
+    def has_previous(self):
+        return self._has_previous
+    
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+    
+    def next_page_number(self):
+        return self.number + 1
+    
+    def previous_page_number(self):
+        return self.number - 1
+    
+    @property
+    def next_after(self):
+        """
+        The ``after`` parameter for the next page.
+        """
+        if self._has_next and self.object_list:
+            return self.object_list[-1].pk
+        return None
+    
+    @property
+    def previous_before(self):
+        """
+        The ``before`` parameter for the previous page.
+        """
+        if self._has_previous and self.object_list:
+            return self.object_list[0].pk
+        return None
+
+
+def keyset_page(queryset, per_page, after=None, before=None, count=None, number=None):
+    """
+    Returns the ``KeysetPage`` of ``queryset`` following primary key
+    ``after``, or preceding ``before``, or else page ``number``, by
+    default the first one.
+    """
+    if before is not None:
+        rows = list(queryset.filter(pk__lt=before).order_by("-pk")[:per_page + 1])
+        has_previous = len(rows) > per_page
+        rows = rows[:per_page]
+        rows.reverse()
+        # the first page is page 1, whatever number it was asked by
+        number = has_previous and max(number or 2, 2) or 1
+        return KeysetPage(rows, True, has_previous, count, number)
+    if after is not None:
+        queryset = queryset.filter(pk__gt=after)
+        number = max(number or 2, 2)
+        offset = 0
+    else:
+        number = max(number or 1, 1)
+        offset = (number - 1) * per_page
+    rows = list(queryset.order_by("pk")[offset:offset + per_page + 1])
+    return KeysetPage(rows[:per_page], len(rows) > per_page, number > 1, count, number)
@@ -0,0 +1,70 @@
+"""
+Progress of running imports, kept in the cache so that clients can poll it
+cheaply (see ``views.import_status``).
+
+Settings:
+
+    CONTACTS_IMPORT_PROGRESS_INTERVAL  contacts between two updates (500)
+    CONTACTS_IMPORT_PROGRESS_TIMEOUT   seconds a record is kept (3600)
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+PROGRESS_INTERVAL = getattr(settings, "CONTACTS_IMPORT_PROGRESS_INTERVAL", 500)
+PROGRESS_TIMEOUT = getattr(settings, "CONTACTS_IMPORT_PROGRESS_TIMEOUT", 60 * 60)
+
+
+def progress_key(task_id):
+    return "contacts_import:progress:%s" % task_id
+
+
+def get_progress(task_id):
+    return cache.get(progress_key(task_id))
+
+
+def mark_pending(task_id, owner):
+    """
+    Records a queued import. Does nothing if a worker already picked it up.
+    """
+    cache.add(progress_key(task_id), {
+        "state": "PENDING",
+        "owner": owner.pk,
+        "seen": 0,
+        "imported": 0,
+        "rate": 0.0,
+    }, PROGRESS_TIMEOUT)
+
+
+class ProgressTracker(object):
+    
+    def __init__(self, task_id, owner, interval=PROGRESS_INTERVAL):
+        self.task_id = task_id
+        self.owner = owner
+        self.interval = interval
+        self.started = time.time()
+        self.reported = None
+    
+    def update(self, seen, status, state="PROGRESS"):
+        """
+        Stores the current counts, at most once every ``interval`` contacts
+        unless the state changes.
+        """
+        if state == "PROGRESS" and self.reported is not None:
+            if seen - self.reported < self.interval:
+                return
+        self.reported = seen
+        elapsed = time.time() - self.started
+        record = {
+            "state": state,
+            "owner": self.owner.pk,
+            "seen": seen,
+            "imported": status["imported"],
+            "rate": elapsed and seen / elapsed or 0.0,
+        }
+        if state == "DONE":
+            record["result"] = status
+        cache.set(progress_key(self.task_id), record, PROGRESS_TIMEOUT)
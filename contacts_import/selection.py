@@ -0,0 +1,170 @@
+"""
+The contacts a user ticked while paging through an import, kept in the
+session as a bitmap over their primary keys.
+
+Contacts of one import get (mostly) consecutive keys, so one bit per key
+between the lowest and the highest selected is a few kilobytes even for
+tens of thousands of contacts, and compresses well when the selection is
+sparse. The session holds the encoded bitmap; the decoded
+``ContactSelection`` is cached on the session object for the rest of the
+request, so checking every row of a page costs one bit test each, and the
+session is only written back when the selection actually changed.
+"""
+
+import base64
+import zlib
+
+
+SESSION_KEY = "selected-contacts"
+
+BIT_COUNTS = [bin(i).count("1") for i in xrange(256)]
+
+
+def _keys(pks):
+    # keys come from the request; anything that isn't one is left out
+    for pk in pks:
+        try:
+            yield int(pk)
+        except (TypeError, ValueError):
+            pass
+
+
+class ContactSelection(object):
+    
+    def __init__(self, base=0, bitmap=None):
+        # bit i of the bitmap is the contact with primary key base + i;
+        # base is kept a multiple of 8 so that growing down adds whole bytes
+        self.base = base
+        self.bitmap = bitmap if bitmap is not None else bytearray()
+        self.modified = False
+    
+    @classmethod
+    def decode(cls, value):
+        base, sep, data = value.partition(":")
+        return cls(int(base), bytearray(zlib.decompress(base64.b64decode(data))))
+    
+    def encode(self):
+        self.trim()
+        return "%d:%s" % (self.base, base64.b64encode(zlib.compress(str(self.bitmap))))
+    
+    @classmethod
+    def for_session(cls, session):
+        """
+        The selection stored in ``session``, decoded once per request.
+        """
+        selection = getattr(session, "_contacts_import_selection", None)
+        if selection is None:
+            value = session.get(SESSION_KEY)
+            if not value:
+                selection = cls()
+            elif isinstance(value, basestring):
+                selection = cls.decode(value)
+            else:
+                # a set of string keys, as stored by earlier versions
+                selection = cls()
+                selection.select(value)
+                selection.modified = True
+            session._contacts_import_selection = selection
+        return selection
+    
+    def save(self, session):
+        if not self.modified:
+            return
+        if self:
+            session[SESSION_KEY] = self.encode()
+        else:
+            session.pop(SESSION_KEY, None)
+        self.modified = False
+    
+    def clear(self):
+        if self.bitmap:
+            self.modified = True
+        self.base = 0
+        self.bitmap = bytearray()
+    
+    def _grow(self, pk):
+        if not self.bitmap:
+            self.base = pk & ~7
+        elif pk < self.base:
+            base = pk & ~7
+            self.bitmap[0:0] = bytearray((self.base - base) // 8)
+            self.base = base
+        offset = pk - self.base
+        if offset // 8 >= len(self.bitmap):
+            self.bitmap.extend(bytearray(offset // 8 - len(self.bitmap) + 1))
+        return offset
+    
+    def add(self, pk):
+        offset = self._grow(int(pk))
+        mask = 1 << (offset & 7)
+        if not self.bitmap[offset // 8] & mask:
+            self.bitmap[offset // 8] |= mask
+            self.modified = True
+    
+    def discard(self, pk):
+        offset = int(pk) - self.base
+        if 0 <= offset < len(self.bitmap) * 8:
+            mask = 1 << (offset & 7)
+            if self.bitmap[offset // 8] & mask:
+                self.bitmap[offset // 8] &= ~mask
+                self.modified = True
+    
+    def select(self, pks):
+        for pk in _keys(pks):
+            self.add(pk)
+    
+    def deselect(self, pks):
+        for pk in _keys(pks):
+            self.discard(pk)
+    
+    def update_page(self, on_page, selected):
+        """
+        Makes the selection agree with a submitted page: of the keys
+        ``on_page``, exactly those in ``selected`` are selected.
+        """
+        selected = set(_keys(selected))
+        for pk in _keys(on_page):
+            if pk in selected:
+                self.add(pk)
+            else:
+                self.discard(pk)
+    
+    def trim(self):
+        """
+        Drops the empty bytes at both ends of the bitmap.
+        """
+        end = len(self.bitmap)
+        while end and not self.bitmap[end - 1]:
+            end -= 1
+        start = 0
+        while start < end and not self.bitmap[start]:
+            start += 1
+        if start or end < len(self.bitmap):
+            self.bitmap = self.bitmap[start:end]
+            self.base = self.bitmap and self.base + start * 8 or 0
+    
+    def __contains__(self, pk):
+        try:
+            offset = int(pk) - self.base
+        except (TypeError, ValueError):
+            return False
+        if not 0 <= offset < len(self.bitmap) * 8:
+            return False
+        return bool(self.bitmap[offset // 8] & (1 << (offset & 7)))
+    
+    def __iter__(self):
+        """
+        Yields the selected primary keys in ascending order.
+        """
+        for i, byte in enumerate(self.bitmap):
+            if byte:
+                base = self.base + i * 8
+                for bit in xrange(8):
+                    if byte & (1 << bit):
+                        yield base + bit
+    
+    def __len__(self):
+        return sum([BIT_COUNTS[byte] for byte in self.bitmap])
+    
+    def __nonzero__(self):
+        return any(self.bitmap)
@@ -1,3 +1,6 @@
+import sys
+import types
+
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 try:
@@ -14,6 +17,10 @@ def map_to_attr(setting, default=None):
             raise ImproperlyConfigured("You must define '%s' in settings" % setting)
     else:
         path = getattr(settings, setting, default)
+    return import_attr(path)
+
+
+def import_attr(path):
     i = path.rfind(".")
     module, attr = path[:i], path[i+1:]
     try:
@@ -27,14 +34,67 @@ def map_to_attr(setting, default=None):
     return attr
 
 
-DEFAULT_PERSISTANCE = map_to_attr(
-    "CONTACTS_IMPORT_DEFAULT_PERSISTANCE",
-    "contacts_import.backends.persistance.ModelPersistance"
-)
-RUNNER = map_to_attr(
-    "CONTACTS_IMPORT_RUNNER",
-    "contacts_import.backends.runners.SynchronousRunner"
-)
-CALLBACK = map_to_attr(
-    "CONTACTS_IMPORT_CALLBACK"
-)
\ No newline at end of file
+# resolved on first use, and then kept for the life of the process, rather
+# than when this module is imported: importing the app must not import every
+# backend it is configured with
+_resolved = {}
+
+
+def _resolve(setting, default=None):
+    try:
+        return _resolved[setting]
+    except KeyError:
+        attr = _resolved[setting] = map_to_attr(setting, default)
+        return attr
+
+
+def get_default_persistance():
+    return _resolve(
+        "CONTACTS_IMPORT_DEFAULT_PERSISTANCE",
+        "contacts_import.backends.persistance.ModelPersistance"
+    )
+
+
+def get_runner():
+    return _resolve(
+        "CONTACTS_IMPORT_RUNNER",
+        "contacts_import.backends.runners.SynchronousRunner"
+    )
+
+
+def get_callback():
+    return _resolve(
+        "CONTACTS_IMPORT_CALLBACK"
+    )
+
+
+# DEFAULT_PERSISTANCE, RUNNER and CALLBACK, as earlier versions had them,
+# resolved when read
+_aliases = {
+    "DEFAULT_PERSISTANCE": get_default_persistance,
+    "RUNNER": get_runner,
+    "CALLBACK": get_callback,
+}
+
+
+class _SettingsModule(types.ModuleType):
+    """
+    Stands in for this module to resolve the ``_aliases`` on first use.
+    """
+    
+    def __init__(self, module):
+        super(_SettingsModule, self).__init__(module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+        # the functions above need the globals of the module, which Python
+        # clears when the module goes away
+        self._module = module
+    
+    def __getattr__(self, name):
+        try:
+            alias = _aliases[name]
+        except KeyError:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+        return alias()
+
+
+sys.modules[__name__] = _SettingsModule(sys.modules[__name__])
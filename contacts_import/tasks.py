@@ -1,8 +1,36 @@
-from celery.task import tasks
+from datetime import timedelta
 
-from contacts_import.backends import importers
+from django.conf import settings
 
+from celery.task import tasks, PeriodicTask, Task
 
-tasks.register(importers.VcardImporter)
-tasks.register(importers.GoogleImporter)
-tasks.register(importers.YahooImporter)
\ No newline at end of file
+from contacts_import.backends import fanout, registry
+from contacts_import.backends.importers import get_task
+from contacts_import.models import TransientContact
+
+
+class PersistChunkTask(Task):
+    """
+    Persists one chunk of a large asynchronous import, see
+    ``contacts_import.backends.fanout``.
+    """
+    
+    def run(self, group_id, index, chunk, persistance, credentials, **kwargs):
+        return fanout.persist_chunk(group_id, index, chunk, persistance, credentials)
+
+
+class PurgeTransientContactsTask(PeriodicTask):
+    """
+    Deletes the transient contacts of abandoned imports, see
+    ``TransientContactManager.purge``.
+    """
+    run_every = timedelta(seconds=getattr(settings, "CONTACTS_IMPORT_PURGE_INTERVAL", 60 * 60))
+    
+    def run(self, **kwargs):
+        return TransientContact.objects.purge()
+
+
+for provider in registry.providers():
+    tasks.register(get_task(registry.get_importer(provider)))
+tasks.register(PersistChunkTask)
+tasks.register(PurgeTransientContactsTask)
@@ -1,9 +1,11 @@
 from django import template
 
+from contacts_import.selection import ContactSelection
+
 
 register = template.Library()
 
 
 @register.filter
 def contact_selected(session, pk):
-    return str(pk) in session.get("selected-contacts", ())
+    return pk in ContactSelection.for_session(session)
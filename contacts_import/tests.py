@@ -1,9 +1,42 @@
+import sys
+import threading
+import types
+import urlparse
+
+from datetime import timedelta
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import reverse
+from django.http import HttpResponse
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import simplejson as json
+from django.utils import timezone
 
 from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
 
-from contacts_import.models import TransientContact
+from contacts_import import views
+from contacts_import.backends import fanout, importers, registry
+from contacts_import.backends.importers import BaseImporter, GoogleImporter, EmailListImporter, get_task
+from contacts_import.backends.persistance import ModelPersistance, BulkModelPersistance, InMemoryPersistance
+from contacts_import.backends.runners import GeventRunner, SynchronousRunner, ThreadPoolRunner
+from contacts_import.forms import CsvImportForm, EmailListImportForm, LdifImportForm
+from contacts_import.models import ImportSyncState, TransientContact
+from contacts_import.progress import ProgressTracker, get_progress
+from contacts_import.selection import ContactSelection
+from contacts_import.signals import import_finished
+from contacts_import.utils import dedupe, httpcache, httppool
+from contacts_import.utils.csvfile import iter_csv_contacts
+from contacts_import.utils.dedupe import ContactMerger
+from contacts_import.utils.ldif import iter_ldif_contacts
+from contacts_import.utils.records import ContactChunk, ImportedContact
+from contacts_import.utils.vcard import iter_vcards
 
 
 class BasicTest(TestCase):
@@ -38,3 +71,837 @@ class BasicTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, "Bjarne Stroustrup")
         self.assertContains(response, "Guido van Rossum")
+
+
+class VcardTest(TestCase):
+    
+    def test_iter_vcards(self):
+        stream = StringIO(
+            "BEGIN:VCARD\r\n"
+            "VERSION:3.0\r\n"
+            "FN:Guido van\r\n  Rossum\r\n"
+            "item1.EMAIL;TYPE=INTERNET:guido@python.org\r\n"
+            "EMAIL;TYPE=WORK:gvr@example.com\r\n"
+            "PHOTO;ENCODING=b;TYPE=JPEG:AAAA\r\n BBBB\r\n CCCC\r\n"
+            "END:VCARD\r\n"
+            "BEGIN:VCARD\r\n"
+            "VERSION:2.1\r\n"
+            "FN;CHARSET=UTF-8;ENCODING=QUOTED-PRINTABLE:Bj=C3=B6rn =\r\n"
+            "Stroustrup\r\n"
+            "PHOTO;ENCODING=BASE64;TYPE=JPEG:\r\nAAAABBBB\r\nCCCCDDDD\r\n\r\n"
+            "EMAIL;INTERNET:bjarne@example.com\r\n"
+            "END:VCARD\r\n"
+        )
+        self.assertEqual(list(iter_vcards(stream, chunk_size=7)), [
+            (u"Guido van Rossum", [u"guido@python.org", u"gvr@example.com"]),
+            (u"Bj\xf6rn Stroustrup", [u"bjarne@example.com"]),
+        ])
+
+
+class FileFormatTest(TestCase):
+    
+    def test_iter_csv(self):
+        outlook = (
+            '"First Name","Middle Name","Last Name","E-mail Address","E-mail Type","E-mail 2 Address"\r\n'
+            '"Ren\xe9","","Descartes","rene@example.com","SMTP","R@Example.ORG"\r\n'
+            '"Nobody","","","","SMTP",""\r\n'
+        )
+        self.assertEqual(list(iter_csv_contacts(StringIO(outlook), chunk_size=16)), [
+            (u"Ren\xe9 Descartes", [u"rene@example.com", u"R@example.org"]),
+        ])
+        
+        gmail = (
+            u"Name,Given Name,Family Name,E-mail 1 - Type,E-mail 1 - Value\n"
+            u"Jos\xe9,Jos\xe9,,* Home,jose@example.com ::: jp@example.com\n"
+        ).encode("utf-16")
+        self.assertEqual(list(iter_csv_contacts(StringIO(gmail))), [
+            (u"Jos\xe9", [u"jose@example.com", u"jp@example.com"]),
+        ])
+        
+        # no header, the name comes before the address
+        headerless = "Ada;Lovelace;ada@example.com\nnope;x\nBob;;bob@example.com\n"
+        self.assertEqual(list(iter_csv_contacts(StringIO(headerless))), [
+            (u"Ada Lovelace", [u"ada@example.com"]),
+            (u"Bob", [u"bob@example.com"]),
+        ])
+        
+        # lone CRs, as old Mac exports end lines
+        mac = 'Name,E-mail\r"Ada\rLovelace",ada@example.com\rBob,bob@example.com\r'
+        self.assertEqual(list(iter_csv_contacts(StringIO(mac), chunk_size=8)), [
+            (u"Ada\rLovelace", [u"ada@example.com"]),
+            (u"Bob", [u"bob@example.com"]),
+        ])
+        
+        # UTF-16 without a BOM
+        for encoding in ("utf-16-le", "utf-16-be"):
+            data = u"Name,E-mail\r\nJos\xe9,jose@example.com\r\n".encode(encoding)
+            self.assertEqual(list(iter_csv_contacts(StringIO(data), chunk_size=7)), [
+                (u"Jos\xe9", [u"jose@example.com"]),
+            ])
+    
+    def test_iter_ldif(self):
+        ldif = (
+            "version: 1\n\n"
+            "dn: cn=Ada Lovelace,mail=ada@example.com\n"
+            "cn:: QWRhIExvdmVsYWNl\n"
+            "mail: ada@exam\n"
+            " ple.com\n"
+            "mozillaSecondEmail: lovelace@example.com\n\n"
+            "dn: cn=Bob\n"
+            "givenName: Bob\n"
+            "sn: B\n"
+            "mail: bob@example.com\n\n"
+            "dn: cn=Nobody\n"
+            "cn: Nobody\n"
+        )
+        self.assertEqual(list(iter_ldif_contacts(StringIO(ldif), chunk_size=16)), [
+            (u"Ada Lovelace", [u"ada@example.com", u"lovelace@example.com"]),
+            (u"Bob B", [u"bob@example.com"]),
+        ])
+    
+    def test_csv_form(self):
+        bob = User.objects.create_user("bob", "bob@example.com", "abc123")
+        form = CsvImportForm(files={"csv_file": SimpleUploadedFile("contacts.csv",
+            "Name,E-mail Address\nAda Lovelace,ada@example.com\nBob,bob@example.com\n"
+        )})
+        self.assertTrue(form.is_valid())
+        status = form.save(bob).result
+        self.assertEqual((status["imported"], status["total"]), (2, 2))
+        self.assertEqual(
+            sorted(bob.imported_contacts.values_list("email", "name")),
+            [("ada@example.com", "Ada Lovelace"), ("bob@example.com", "Bob")]
+        )
+        
+        form = CsvImportForm(files={"csv_file": SimpleUploadedFile("contacts.csv",
+            "Name,Phone\nAda,555\n"
+        )})
+        self.assertFalse(form.is_valid())
+        
+        # the csv module gives up on NUL bytes
+        form = CsvImportForm(files={"csv_file": SimpleUploadedFile("contacts.csv",
+            "Name,\x00E-mail\nAda,ada@example.com\n"
+        )})
+        self.assertFalse(form.is_valid())
+        # a bad row further down is skipped and reported
+        form = CsvImportForm(files={"csv_file": SimpleUploadedFile("contacts.csv",
+            "Name,E-mail\nAda,ada@example.com\nB\x00b,bob@example.com\nCy,cy@example.com\n"
+        )})
+        self.assertTrue(form.is_valid())
+        bob.imported_contacts.all().delete()
+        status = form.save(bob).result
+        self.assertEqual(status["imported"], 2)
+        self.assertEqual(status["rejected_count"], 1)
+        self.assertEqual([(line, reason) for line, error, reason in status["rejected"]],
+                         [(3, "unreadable")])
+    
+    def test_ldif_form(self):
+        form = LdifImportForm(files={"ldif_file": SimpleUploadedFile("contacts.ldif",
+            "dn: cn=Ada\ncn: Ada\n\ndn: cn=Bob\ncn: Bob\nmail: bob@example.com\n"
+        )})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data["ldif_file"].tell(), 0)
+        form = LdifImportForm(files={"ldif_file": SimpleUploadedFile("contacts.ldif",
+            "dn: cn=Ada\ncn: Ada\n"
+        )})
+        self.assertFalse(form.is_valid())
+
+
+class FeedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class GoogleFeedHandler(BaseHTTPRequestHandler):
+    """
+    Serves a fake Google contacts feed with five people. Only the first
+    page carries a ``next`` link; later ones rely on the OpenSearch
+    elements.
+    """
+    
+    protocol_version = "HTTP/1.1"
+    people = [("Person %d" % i, "person%d@example.com" % i) for i in range(5)]
+    etag = '"v1"'
+    updated = "2013-01-01T00:00:00.000Z"
+    
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        self.server.requests.append(query)
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start = int(query["start-index"])
+        per_page = int(query["max-results"])
+        entries = [
+            {"title": {"$t": name}, "gd$email": [{"address": email}]}
+            for name, email in self.people[start-1:start-1+per_page]
+        ]
+        feed = {
+            "entry": entries,
+            "openSearch$totalResults": {"$t": str(len(self.people))},
+            "openSearch$startIndex": {"$t": str(start)},
+            "updated": {"$t": self.updated},
+            "link": [],
+        }
+        if start == 1:
+            feed["link"].append({
+                "rel": "next",
+                "href": "http://%s:%s%s?alt=json&max-results=%s&start-index=%s" % (
+                    self.server.server_address + (url.path, per_page, start + per_page)
+                ),
+            })
+        body = json.dumps({"feed": feed})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+
+class GoogleImporterTest(TestCase):
+    
+    def setUp(self):
+        self.server = FeedServer(("127.0.0.1", 0), GoogleFeedHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def tearDown(self):
+        # close the pooled keep-alive connections to the stub server
+        host = "http:%s:%s" % self.server.server_address
+        for http in httppool.get_pool().idle.pop(host, []):
+            for conn in http.connections.values():
+                conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def test_follows_pages(self):
+        importer = GoogleImporter()
+        importer.contacts_uri = "http://%s:%s/feed" % self.server.server_address
+        importer.page_size = 2
+        reused = httppool.stats()["connections_reused"]
+        contacts = importer.get_contacts({"authsub_token": "token"})
+        self.assertEqual(contacts.next(), {
+            "name": "Person 0",
+            "email": "person0@example.com",
+        })
+        # contacts are handed out before later pages are requested
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(list(contacts)), 4)
+        self.assertEqual(
+            [int(query["start-index"]) for query in self.server.requests],
+            [1, 3, 5]
+        )
+        # the three pages went over one keep-alive connection
+        self.assertEqual(httppool.stats()["connections_reused"] - reused, 2)
+    
+    def test_prefetch(self):
+        importer = GoogleImporter()
+        importer.contacts_uri = "http://%s:%s/feed" % self.server.server_address
+        importer.page_size = 2
+        with self.settings(CONTACTS_IMPORT_PREFETCH={"google": 2}):
+            contacts = list(importer.get_contacts({"authsub_token": "token"}))
+        self.assertEqual(
+            [contact["email"] for contact in contacts],
+            [email for name, email in GoogleFeedHandler.people]
+        )
+        self.assertEqual(
+            sorted(int(query["start-index"]) for query in self.server.requests),
+            [1, 3, 5]
+        )
+
+
+    def test_incremental(self):
+        bob = User.objects.create_user("bob", "bob@example.com")
+        def run():
+            importer = GoogleImporter()
+            importer.incremental = True
+            importer.contacts_uri = "http://%s:%s/feed" % self.server.server_address
+            return importer.run({"user": bob, "authsub_token": "token"}, ModelPersistance())
+        self.assertEqual(run()["added"], 5)
+        state = ImportSyncState.objects.get(owner=bob, provider="google")
+        self.assertEqual((state.token, state.etag), (GoogleFeedHandler.updated, GoogleFeedHandler.etag))
+        # nothing changed, Google answers 304
+        self.assertEqual(run()["total"], 0)
+        self.assertEqual(self.server.requests[-1]["updated-min"], GoogleFeedHandler.updated)
+    
+    def test_reused_importer(self):
+        bob = User.objects.create_user("bob", "bob@example.com")
+        alice = User.objects.create_user("alice", "alice@example.com")
+        # Celery runs every import on the same task instance
+        importer = GoogleImporter()
+        importer.incremental = True
+        importer.contacts_uri = "http://%s:%s/feed" % self.server.server_address
+        ImportSyncState.objects.create(owner=bob, provider="google", token=GoogleFeedHandler.updated)
+        importer.run({"user": bob, "authsub_token": "token"}, ModelPersistance())
+        self.assertTrue("updated-min" in self.server.requests[0])
+        first = len(self.server.requests)
+        status = importer.run({"user": alice, "authsub_token": "token"}, ModelPersistance())
+        self.assertEqual(status["added"], 5)
+        self.assertFalse("updated-min" in self.server.requests[first])
+        self.assertEqual(ImportSyncState.objects.get(owner=alice, provider="google").etag, GoogleFeedHandler.etag)
+
+
+    def test_response_cache(self):
+        url = "http://%s:%s/feed?start-index=1&max-results=2" % self.server.server_address
+        for ttl in (300, 0):
+            cache = httpcache.ResponseCache(httpcache.LRUStore(1024 * 1024), ttl=ttl)
+            pool = httppool.HttpPool(cache=cache)
+            try:
+                pool.request(url, cache_scope="google:1")
+                response, content = pool.request(url, cache_scope="google:1")
+                pool.request(url, cache_scope="google:2")
+            finally:
+                for http in pool.idle.values()[0]:
+                    for conn in http.connections.values():
+                        conn.close()
+            self.assertTrue(response.fromcache)
+            self.assertEqual(len(json.loads(content)["feed"]["entry"]), 2)
+            stats = cache.stats()
+            self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+            # stale responses are revalidated with their ETag
+            self.assertEqual(stats["revalidated"], int(ttl == 0))
+        self.assertEqual(len(self.server.requests), 5)
+
+
+class ImportStatusTest(TestCase):
+    
+    def setUp(self):
+        self.bob = User.objects.create_user("bob", "bob@example.com", "abc123")
+        self.alice = User.objects.create_user("alice", "alice@example.com", "abc123")
+    
+    def test_import_status(self):
+        progress = ProgressTracker("task-1", self.bob, interval=100)
+        progress.update(100, {"imported": 80, "total": 100})
+        # not reported, less than interval contacts since the last update
+        progress.update(150, {"imported": 120, "total": 150})
+        url = reverse("import_status", kwargs={"task_id": "task-1"})
+        
+        self.client.login(username="bob", password="abc123")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data["state"], "PROGRESS")
+        self.assertEqual((data["seen"], data["imported"]), (100, 80))
+        self.assertTrue("owner" not in data)
+        
+        progress.update(150, {"imported": 120, "total": 150}, state="DONE")
+        data = json.loads(self.client.get(url).content)
+        self.assertEqual(data["state"], "DONE")
+        self.assertEqual(data["result"], {"imported": 120, "total": 150})
+        
+        self.client.login(username="alice", password="abc123")
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+    def test_thread_pool_runner(self):
+        # the threads can't see the test database, keep the contacts in memory
+        persistance = InMemoryPersistance()
+        runner = ThreadPoolRunner(EmailListImporter, lambda: persistance,
+            user = self.bob,
+            stream = StringIO("a@example.com\nb@example.com"),
+        )
+        results = runner.import_contacts()
+        results.future.result(timeout=10)
+        self.assertTrue(results.ready())
+        self.assertEqual(results.status, "DONE")
+        self.assertEqual(results.result["imported"], 2)
+        self.assertEqual(sorted(c["email"] for c in persistance.contacts()),
+                         ["a@example.com", "b@example.com"])
+        self.assertEqual(get_progress(results.task_id)["state"], "DONE")
+    
+    def test_gevent_runner(self):
+        try:
+            import gevent.monkey
+        except ImportError:
+            return
+        persistance = InMemoryPersistance()
+        is_module_patched = gevent.monkey.is_module_patched
+        # the import below does no I/O, it needn't be patched to run
+        gevent.monkey.is_module_patched = lambda name: True
+        try:
+            runner = GeventRunner(EmailListImporter, lambda: persistance,
+                user = self.bob,
+                stream = StringIO("a@example.com\nb@example.com"),
+            )
+        finally:
+            gevent.monkey.is_module_patched = is_module_patched
+        results = runner.import_contacts()
+        results.greenlet.join(timeout=10)
+        self.assertEqual(results.status, "DONE")
+        self.assertEqual(results.result["imported"], 2)
+        self.assertEqual(sorted(c["email"] for c in persistance.contacts()),
+                         ["a@example.com", "b@example.com"])
+        self.assertEqual(get_progress(results.task_id)["state"], "DONE")
+
+
+class SyncedImporter(EmailListImporter):
+    """
+    An email list import that keeps a sync state, as the Google and Yahoo
+    importers do.
+    """
+    provider = "synced"
+    incremental = True
+    
+    def get_contacts(self, credentials):
+        self.load_sync_state(credentials)
+        self.next_sync_token = "next"
+        return super(SyncedImporter, self).get_contacts(credentials)
+
+
+class PersistanceTest(TestCase):
+    
+    emails = ["a@example.com", "b@example.com", "a@example.com", "c@example.com"]
+    
+    def setUp(self):
+        self.bob = User.objects.create_user("bob", "bob@example.com", "abc123")
+        TransientContact.objects.create(owner=self.bob, email="c@example.com")
+    
+    def run_import(self, persistance):
+        runner = SynchronousRunner(EmailListImporter, persistance,
+            user = self.bob,
+            stream = self.emails,
+        )
+        return runner.import_contacts().result
+    
+    def check_import(self, persistance):
+        finished = []
+        def receiver(sender, **kwargs):
+            finished.append(kwargs["stats"])
+        import_finished.connect(receiver)
+        try:
+            status = self.run_import(persistance)
+        finally:
+            import_finished.disconnect(receiver)
+        # the repeated address is merged before it reaches the backend
+        self.assertEqual((status["imported"], status["total"]), (2, 3))
+        self.assertEqual((status["added"], status["updated"], status["unchanged"]), (2, 0, 1))
+        self.assertEqual(
+            sorted(self.bob.imported_contacts.values_list("email", flat=True)),
+            ["a@example.com", "b@example.com", "c@example.com"]
+        )
+        self.assertEqual(finished, [status["stats"]])
+        self.assertEqual(status["stats"]["contacts"], 4)
+        self.assertEqual(status["stats"]["merged"], 1)
+        return status
+    
+    def test_model_persistance(self):
+        status = self.check_import(ModelPersistance)
+        self.assertEqual(status["stats"]["queries"], 3)
+    
+    def test_bulk_persistance(self):
+        status = self.check_import(BulkModelPersistance)
+        self.assertEqual(status["stats"]["queries"], 2)
+    
+    def test_same_status(self):
+        # repeated addresses, as they come with CONTACTS_IMPORT_DEDUPE off
+        contacts = ContactChunk([
+            ImportedContact("a@example.com", "A"),
+            ImportedContact("c@example.com", "Cee"),
+            ImportedContact("a@example.com", "Ann"),
+            ImportedContact("c@example.com"),
+            ImportedContact("a@example.com"),
+        ])
+        results = []
+        for persistance in (ModelPersistance(), BulkModelPersistance()):
+            TransientContact.objects.filter(owner=self.bob).update(name="")
+            TransientContact.objects.filter(email="a@example.com").delete()
+            status = persistance.persist_chunk(contacts, persistance.default_status(), {"user": self.bob})
+            status = persistance.flush(status, {"user": self.bob})
+            results.append((status, sorted(self.bob.imported_contacts.values_list("email", "name"))))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][0], {"total": 5, "imported": 1, "added": 1, "updated": 2, "unchanged": 2})
+        self.assertEqual(results[0][1], [("a@example.com", "Ann"), ("c@example.com", "Cee")])
+    
+    def test_in_memory_persistance(self):
+        backend = InMemoryPersistance(max_contacts=1)
+        contacts = [
+            {"email": "a@example.com", "name": ""},
+            {"email": "b@example.com", "name": ""},
+            {"email": "b@example.com", "name": "Bob"},
+            {"email": "a@example.com", "name": ""},
+        ]
+        try:
+            # filled on a runner's thread, read on this one
+            results = []
+            thread = threading.Thread(target=lambda: results.append(
+                backend.persist_chunk(contacts, backend.default_status(), {})
+            ))
+            thread.start()
+            thread.join()
+            status = results[0]
+            self.assertEqual((status["added"], status["updated"], status["unchanged"]), (2, 1, 1))
+            # b went to the spill file
+            self.assertTrue(backend.spill is not None)
+            self.assertEqual((len(backend), backend.get("b@example.com")), (2, "Bob"))
+            status = backend.commit({"user": self.bob})
+            self.assertEqual(status["imported"], 2)
+            self.assertEqual(self.bob.imported_contacts.get(email="b@example.com").name, "Bob")
+        finally:
+            backend.close()
+    
+    def test_count_invalidated(self):
+        self.assertEqual(TransientContact.objects.count_for(self.bob), 1)
+        self.run_import(BulkModelPersistance)
+        self.assertEqual(TransientContact.objects.count_for(self.bob), 3)
+
+
+    def test_delete_and_purge(self):
+        alice = User.objects.create_user("alice", "alice@example.com")
+        TransientContact.objects.create(owner=alice, email="a@example.com")
+        self.run_import(ModelPersistance)
+        self.assertEqual(TransientContact.objects.count_for(self.bob), 3)
+        ImportSyncState.objects.create(owner=self.bob, provider="google", token="t")
+        self.assertEqual(TransientContact.objects.delete_for(self.bob, batch_size=2), 3)
+        self.assertEqual(TransientContact.objects.count_for(self.bob), 0)
+        self.assertFalse(ImportSyncState.objects.exists())
+        
+        self.assertEqual(TransientContact.objects.purge(60), 0)
+        TransientContact.objects.update(created=timezone.now() - timedelta(days=2))
+        ImportSyncState.objects.create(owner=alice, provider="google", token="t")
+        self.assertEqual(TransientContact.objects.purge(60), 1)
+        self.assertFalse(TransientContact.objects.exists())
+        self.assertFalse(ImportSyncState.objects.exists())
+    
+    def test_fan_out(self):
+        # run the chunk tasks in place of Celery
+        def dispatch(fan_out, chunk):
+            fanout.persist_chunk(fan_out.group_id, fan_out.chunks, chunk,
+                BulkModelPersistance(), fan_out.credentials
+            )
+            fan_out.chunks += 1
+        original, fanout.ChunkFanOut.dispatch = fanout.ChunkFanOut.dispatch, dispatch
+        try:
+            importer = SyncedImporter()
+            importer.chunk_size = 1
+            importer.run({"user": self.bob, "stream": self.emails}, BulkModelPersistance(),
+                task_id = "fan-out",
+                fan_out = True,
+            )
+        finally:
+            fanout.ChunkFanOut.dispatch = original
+        progress = get_progress("fan-out")
+        self.assertEqual(progress["state"], "DONE")
+        self.assertEqual(progress["result"]["imported"], 2)
+        self.assertEqual(progress["result"]["total"], 3)
+        self.assertEqual(progress["result"]["stats"]["contacts"], 4)
+        self.assertEqual(self.bob.imported_contacts.count(), 3)
+        # stored once every chunk was persisted
+        self.assertEqual(ImportSyncState.objects.get(owner=self.bob, provider="synced").token, "next")
+    
+    def test_fan_out_task(self):
+        # as a Celery worker runs it, on the class made by get_task
+        modules = {}
+        try:
+            import celery.task
+        except ImportError:
+            # a stand-in for the one thing get_task needs of Celery
+            celery = types.ModuleType("celery")
+            celery.task = types.ModuleType("celery.task")
+            celery.task.Task = type("Task", (object,), {})
+            modules = {"celery": celery, "celery.task": celery.task}
+        sys.modules.update(modules)
+        def dispatch(fan_out, chunk):
+            fanout.persist_chunk(fan_out.group_id, fan_out.chunks, chunk,
+                BulkModelPersistance(), fan_out.credentials
+            )
+            fan_out.chunks += 1
+        original, fanout.ChunkFanOut.dispatch = fanout.ChunkFanOut.dispatch, dispatch
+        try:
+            importer = get_task(SyncedImporter)()
+            importer.chunk_size = 1
+            importer.run({"user": self.bob, "stream": self.emails}, BulkModelPersistance(),
+                task_id = "fan-out-task",
+                fan_out = True,
+            )
+        finally:
+            fanout.ChunkFanOut.dispatch = original
+            for name in modules:
+                del sys.modules[name]
+            importers._tasks.pop(SyncedImporter, None)
+        self.assertEqual(get_progress("fan-out-task")["state"], "DONE")
+        self.assertEqual(self.bob.imported_contacts.count(), 3)
+    
+    def test_fan_out_failure(self):
+        class FailingPersistance(BulkModelPersistance):
+            def persist_chunk(self, contacts, status, credentials):
+                raise IOError("database went away")
+        failures = []
+        def dispatch(fan_out, chunk):
+            persistance = fan_out.chunks == 1 and FailingPersistance() or BulkModelPersistance()
+            try:
+                fanout.persist_chunk(fan_out.group_id, fan_out.chunks, chunk,
+                    persistance, fan_out.credentials
+                )
+            except IOError, e:
+                failures.append(e)
+            fan_out.chunks += 1
+        original, fanout.ChunkFanOut.dispatch = fanout.ChunkFanOut.dispatch, dispatch
+        try:
+            importer = SyncedImporter()
+            importer.chunk_size = 1
+            importer.run({"user": self.bob, "stream": self.emails}, BulkModelPersistance(),
+                task_id = "fan-out-failure",
+                fan_out = True,
+            )
+        finally:
+            fanout.ChunkFanOut.dispatch = original
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(get_progress("fan-out-failure")["state"], "FAILURE")
+        # the next import must ask for the contacts of the failed chunk again
+        self.assertFalse(ImportSyncState.objects.filter(owner=self.bob).exists())
+
+class KeysetPageTest(TestCase):
+    
+    def setUp(self):
+        self.bob = User.objects.create_user("bob", "bob@example.com", "abc123")
+        for i in range(5):
+            TransientContact.objects.create(owner=self.bob, email="%d@example.com" % i)
+        self.pks = list(self.bob.imported_contacts.values_list("pk", flat=True))
+    
+    def test_pages(self):
+        manager = TransientContact.objects
+        page = manager.page_for(self.bob, 2)
+        self.assertEqual([c.pk for c in page], self.pks[:2])
+        self.assertTrue(page.has_next())
+        self.assertFalse(page.has_previous())
+        self.assertEqual(page.count, 5)
+        
+        page = manager.page_for(self.bob, 2, after=page.next_after)
+        page = manager.page_for(self.bob, 2, after=page.next_after)
+        self.assertEqual([c.pk for c in page], self.pks[4:])
+        self.assertFalse(page.has_next())
+        
+        page = manager.page_for(self.bob, 2, before=page.previous_before)
+        self.assertEqual([c.pk for c in page], self.pks[2:4])
+        self.assertTrue(page.has_previous())
+        
+        page = manager.page_for(self.bob, 2, before=self.pks[2], number=2)
+        self.assertEqual([c.pk for c in page], self.pks[:2])
+        self.assertFalse(page.has_previous())
+        self.assertEqual(page.number, 1)
+    
+    def test_page_number(self):
+        manager = TransientContact.objects
+        page = manager.page_for(self.bob, 2, after=self.pks[1], number=2)
+        self.assertEqual((page.number, page.next_page_number()), (2, 3))
+        # old ?page=<n> links
+        page = manager.page_for(self.bob, 2, number=3)
+        self.assertEqual([c.pk for c in page], self.pks[4:])
+        self.assertTrue(page.has_previous())
+        self.assertFalse(page.has_next())
+
+
+
+class SelectionTest(TestCase):
+    
+    def test_selection(self):
+        selection = ContactSelection()
+        selection.select([1005, 1003, 1020])
+        selection.add("998")
+        selection.discard(1020)
+        self.assertEqual(list(selection), [998, 1003, 1005])
+        self.assertEqual(len(selection), 3)
+        self.assertTrue("1003" in selection)
+        self.assertFalse(1004 in selection)
+        self.assertFalse(None in selection)
+        
+        selection.update_page([998, 1003, 1004], ["1004"])
+        self.assertEqual(list(ContactSelection.decode(selection.encode())), [1004, 1005])
+    
+    def test_tampered_keys(self):
+        selection = ContactSelection()
+        selection.select(["3", "", "x"])
+        selection.update_page([3, 4], ["4", "", "4; drop", None])
+        self.assertEqual(list(selection), [4])
+        session = SessionStore()
+        session["selected-contacts"] = set(["3", "abc"])
+        self.assertEqual(list(ContactSelection.for_session(session)), [3])
+    
+    def test_session(self):
+        session = SessionStore()
+        session["selected-contacts"] = set(["3", "7"])
+        selection = ContactSelection.for_session(session)
+        self.assertTrue(selection is ContactSelection.for_session(session))
+        selection.save(session)
+        self.assertTrue(isinstance(session["selected-contacts"], basestring))
+        selection.clear()
+        selection.save(session)
+        self.assertFalse("selected-contacts" in session)
+    
+    def test_callback(self):
+        bob = User.objects.create_user("bob", "bob@example.com", "abc123")
+        contacts = [
+            TransientContact.objects.create(owner=bob, email="%d@example.com" % i)
+            for i in range(2)
+        ]
+        received = []
+        def callback(request, selected):
+            received.append(selected)
+            return HttpResponse("done")
+        request = RequestFactory().post("/", {
+            "action": "import-contacts",
+            "finish": "1",
+            "selected-contacts": [str(contacts[1].pk)],
+        })
+        request.user = bob
+        request.session = SessionStore()
+        get_callback, views.get_callback = views.get_callback, lambda: callback
+        try:
+            response = views.import_contacts_old(request)
+        finally:
+            views.get_callback = get_callback
+        self.assertEqual(response.content, "done")
+        self.assertEqual(received, [set([str(contacts[1].pk)])])
+        self.assertFalse(bob.imported_contacts.exists())
+
+
+class MergeTest(TestCase):
+    
+    def test_merge(self):
+        merger = ContactMerger(fold_gmail=True, name_policy="longest")
+        first = merger.merge([
+            {"email": "J.Doe+news@gmail.com", "name": "John"},
+            {"email": "ada@example.com", "name": ""},
+            {"email": "jdoe@googlemail.com", "name": "John Doe"},
+            {"email": "ADA@example.com", "name": "Ada"},
+        ])
+        self.assertEqual(first, [
+            {"email": "J.Doe+news@gmail.com", "name": "John Doe"},
+            {"email": "ada@example.com", "name": "Ada"},
+        ])
+        # later chunks only drop what was already passed on
+        second = merger.merge([
+            {"email": "jdoe@gmail.com", "name": "Johnny"},
+            {"email": "bob@example.com", "name": "Bob"},
+        ])
+        self.assertEqual(second, [{"email": "bob@example.com", "name": "Bob"}])
+        self.assertEqual(merger.merged, 3)
+    
+    def test_merge_chunk(self):
+        merger = ContactMerger(name_policy="longest")
+        chunk = ContactChunk([
+            ImportedContact("ada@example.com"),
+            {"email": "bob@example.org", "name": "Bob"},
+            ImportedContact("ADA@example.com", "Ada"),
+        ])
+        merged = merger.merge(chunk)
+        self.assertTrue(isinstance(merged, ContactChunk))
+        self.assertEqual(list(merged.pairs()), [("ada@example.com", "Ada"), ("bob@example.org", "Bob")])
+        self.assertEqual(list(merged), [
+            {"email": "ada@example.com", "name": "Ada"},
+            {"email": "bob@example.org", "name": "Bob"},
+        ])
+        # one copy of each domain per chunk
+        self.assertTrue(chunk.domains[0] is chunk.domains[2])
+        self.assertEqual(merger.merged, 1)
+    
+    def test_merge_hash_collision(self):
+        merger = ContactMerger()
+        dedupe.hash = lambda value: 0
+        try:
+            merger.merge([{"email": "ada@example.com", "name": ""}])
+            second = merger.merge(ContactChunk([ImportedContact("bob@example.org")]))
+        finally:
+            del dedupe.hash
+        self.assertEqual(list(second.pairs()), [("bob@example.org", "")])
+        self.assertEqual(merger.merged, 0)
+
+
+class EmailListTest(TestCase):
+    
+    def test_form(self):
+        form = EmailListImportForm({"emails": (
+            'Ada <ada@example.com>; bob@EXAMPLE.com, nope\n'
+            '"Doe, John" <john@example.org>\n'
+            'ADA@example.com x@'
+        )})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.valid_count, 3)
+        self.assertEqual(form.rejected, [
+            (1, "nope", "invalid"),
+            (3, "ADA@example.com", "duplicate"),
+            (3, "x@", "invalid"),
+        ])
+        
+        bob = User.objects.create_user("bob", "bob@example.com", "abc123")
+        status = form.save(bob).result
+        self.assertEqual((status["imported"], status["total"]), (3, 3))
+        self.assertEqual(
+            sorted(bob.imported_contacts.values_list("email", "name")),
+            [("ada@example.com", "Ada"), ("bob@example.com", ""), ("john@example.org", "Doe, John")]
+        )
+    
+    def test_nothing_valid(self):
+        form = EmailListImportForm({"emails": "nope, <nope>"})
+        self.assertFalse(form.is_valid())
+
+
+class LoginImporter(BaseImporter):
+    provider = "login"
+    credential_keys = ("login_token",)
+    logins = 0
+    
+    def login_url(self, request):
+        LoginImporter.logins += 1
+        return "http://provider.example.com/login?n=%d" % self.logins
+    
+    def login_callback(self, request):
+        if "token" in request.GET:
+            request.session["login_token"] = request.GET["token"]
+    
+    def get_contacts(self, credentials):
+        yield ImportedContact("%s@example.com" % credentials["login_token"], "")
+
+
+@override_settings(CONTACTS_IMPORT_IMPORTERS={"login": "contacts_import.tests.LoginImporter"})
+class DispatchViewTest(TestCase):
+    
+    def setUp(self):
+        self.bob = User.objects.create_user("bob", "bob@example.com", "abc123")
+        self.client.login(username="bob", password="abc123")
+    
+    def test_form_provider(self):
+        url = reverse("contacts_import_from", kwargs={"provider": "email_list"})
+        response = self.client.post(url, {"emails": "ada@example.com, nope"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(self.bob.imported_contacts.values_list("email", flat=True)),
+            ["ada@example.com"])
+        
+        url = reverse("contacts_import_from", kwargs={"provider": "nope"})
+        self.assertEqual(self.client.get(url).status_code, 404)
+    
+    def test_login_provider(self):
+        LoginImporter.logins = 0
+        url = reverse("contacts_import_from", kwargs={"provider": "login"})
+        response = self.client.get(url)
+        self.assertEqual(response["Location"], "http://provider.example.com/login?n=1")
+        # worked out once per session
+        response = self.client.get(url)
+        self.assertEqual(response["Location"], "http://provider.example.com/login?n=1")
+        
+        callback = reverse("contacts_import_callback", kwargs={"provider": "login"})
+        response = self.client.get(callback, {"token": "ada"})
+        self.assertTrue(response["Location"].endswith(reverse("select_contacts")))
+        self.assertEqual(list(self.bob.imported_contacts.values_list("email", flat=True)),
+            ["ada@example.com"])
+        self.assertTrue("login_token" not in self.client.session)
+        
+        # the login URL was used up, and not coming back with a token fails
+        response = self.client.get(callback)
+        self.assertTrue(response["Location"].endswith(reverse("import_contacts")))
+        response = self.client.get(url)
+        self.assertEqual(response["Location"], "http://provider.example.com/login?n=2")
+    
+    def test_turned_off_provider(self):
+        self.assertTrue(registry.get_importer("email_list") is EmailListImporter)
+        with self.settings(CONTACTS_IMPORT_IMPORTERS={"email_list": None}):
+            self.assertRaises(KeyError, registry.get_importer, "email_list")
+            url = reverse("contacts_import_from", kwargs={"provider": "email_list"})
+            self.assertEqual(self.client.get(url).status_code, 404)
@@ -5,10 +5,15 @@ import views
 urlpatterns = patterns('',
     url(r'^import_contacts/$', views.import_contacts, name='import_contacts'),
 
-    # Backends
+    # Backends, any provider in contacts_import.backends.registry
+    url(r'^import/(?P<provider>[\w-]+)/$', views.import_from, name='contacts_import_from'),
+    url(r'^import/(?P<provider>[\w-]+)/callback/$', views.import_callback, name='contacts_import_callback'),
     url(r'^import_google_contacts/$', views.import_google_contacts, name='import_google_contacts'),
     url(r'^import_email_list/$', views.import_email_list, name='import_email_list'),
 
     # Contact selection
     url(r'^select_contacts/$', views.select_contacts, name='select_contacts'),
+    
+    # Progress of asynchronous imports
+    url(r'^import_status/(?P<task_id>[\w-]+)/$', views.import_status, name='import_status'),
 )
@@ -0,0 +1,243 @@
+"""
+Streaming reader for address books exported as CSV, by Outlook, Gmail,
+Yahoo, Thunderbird and most everything else. Usage::
+
+    >>> from StringIO import StringIO
+    >>> from contacts_import.utils.csvfile import iter_csv_contacts
+    >>> list(iter_csv_contacts(StringIO(
+    ...     "First Name,Last Name,E-mail Address\\r\\n"
+    ...     "Ada,Lovelace,ada@example.com\\r\\n"
+    ... )))
+    [(u'Ada Lovelace', [u'ada@example.com'])]
+
+The dialect and the meaning of the columns are worked out from the first
+``SAMPLE_LINES`` lines. With a header row, email and name columns are
+recognized by their title; without one, the columns holding an address
+in the first row are the email columns and those before them the name.
+Cells may hold several addresses (Gmail separates them with ``:::``).
+
+The file is then read ``chunk_size`` bytes and one row at a time, so
+memory use does not grow with its size. Lines may end with CRLF, LF or a
+lone CR (older Mac exports). UTF-8 (with or without a BOM) and UTF-16, as
+Gmail exports, are read; cells that are not UTF-8 are taken to be
+Windows-1252, as Outlook writes them. Rows the ``csv`` module can't make
+sense of are skipped; ``csv.Error`` is only raised when the first one is.
+"""
+
+import codecs
+import csv
+import re
+
+from itertools import chain, islice
+
+from contacts_import.utils.emails import is_valid_email, normalize_email
+
+
+__all__ = ["iter_csv_contacts", "read_columns", "ColumnMap"]
+
+
+CHUNK_SIZE = 64 * 1024
+
+SAMPLE_LINES = 50
+
+DELIMITERS = ",;\t|"
+
+# separates the addresses of a cell
+SPLIT_RE = re.compile(r":::|[\s,;]+")
+
+# titles are compared lowercased and without spaces, dashes, dots and
+# underscores: "E-mail 2 Address" is "email2address"
+TITLE_RE = re.compile(r"[\s\-_.]+")
+
+NAME_TITLES = ("name", "displayname", "fullname", "fn", "cn")
+# given, middle and family name, in the order they are joined
+NAME_PART_TITLES = (
+    ("firstname", "givenname", "first"),
+    ("middlename", "additionalname", "middle"),
+    ("lastname", "familyname", "surname", "last"),
+)
+
+
+def _normalize_title(title):
+    return TITLE_RE.sub("", title.lower())
+
+
+def _is_email_title(title):
+    # "E-mail Type" and "E-mail Display Name" describe an address
+    return "mail" in title and "type" not in title and "displayname" not in title
+
+
+class ColumnMap(object):
+    """
+    Which columns of a row hold email addresses and which the name.
+    """
+    
+    def __init__(self, email_columns, name_columns):
+        self.email_columns = email_columns
+        self.name_columns = name_columns
+    
+    @classmethod
+    def from_header(cls, row):
+        if [cell for cell in row if _cell_emails(cell)]:
+            # a row of data, not titles
+            return None
+        titles = [_normalize_title(cell) for cell in row]
+        email_columns = [i for i, title in enumerate(titles) if _is_email_title(title)]
+        if not email_columns:
+            return None
+        for wanted in NAME_TITLES:
+            if wanted in titles:
+                return cls(email_columns, [titles.index(wanted)])
+        name_columns = []
+        for names in NAME_PART_TITLES:
+            for wanted in names:
+                if wanted in titles:
+                    name_columns.append(titles.index(wanted))
+                    break
+        return cls(email_columns, name_columns)
+    
+    @classmethod
+    def from_row(cls, row):
+        email_columns = [i for i, cell in enumerate(row) if _cell_emails(cell)]
+        if not email_columns:
+            return None
+        # the name is what comes before the addresses, or after them
+        name_columns = range(email_columns[0]) or range(email_columns[-1] + 1, len(row))
+        return cls(email_columns, name_columns)
+    
+    def name(self, row):
+        parts = [row[i].strip() for i in self.name_columns if i < len(row)]
+        return _decode(" ".join([part for part in parts if part]))
+    
+    def emails(self, row):
+        emails = []
+        for i in self.email_columns:
+            if i < len(row) and row[i]:
+                for email in _cell_emails(row[i]):
+                    if email not in emails:
+                        emails.append(email)
+        return emails
+
+
+def iter_csv_contacts(stream, chunk_size=CHUNK_SIZE, rejected=None):
+    """
+    Yields a ``(name, emails)`` tuple for each row of ``stream`` with at
+    least one valid address; ``name`` may be empty. If ``rejected`` is
+    given, a ``(line number, error, "unreadable")`` tuple is appended to it
+    for every row that was skipped.
+    """
+    columns, rows = read_columns(stream, chunk_size)
+    if columns is None:
+        return
+    count = 0
+    while True:
+        count += 1
+        try:
+            row = next(rows)
+        except StopIteration:
+            return
+        except csv.Error, e:
+            # the reader goes on with the next row
+            if rejected is not None:
+                # the reader knows the line, rows chained after the first
+                # one of a file without a header are counted
+                rejected.append((getattr(rows, "line_num", count), str(e), "unreadable"))
+            continue
+        emails = columns.emails(row)
+        if emails:
+            yield columns.name(row), emails
+
+
+def read_columns(stream, chunk_size=CHUNK_SIZE):
+    """
+    Works out the ``ColumnMap`` of ``stream`` from its first lines and
+    returns it, ``None`` if no column holds email addresses, along with
+    the rows that follow the header.
+    """
+    lines = _iter_lines(stream, chunk_size)
+    sample = list(islice(lines, SAMPLE_LINES))
+    dialect = _sniff_dialect("\n".join([line.rstrip("\r\n") for line in sample]))
+    reader = csv.reader(chain(sample, lines), dialect)
+    first = next(reader, None)
+    if first is None:
+        return None, iter(())
+    columns = ColumnMap.from_header(first)
+    if columns is not None:
+        return columns, reader
+    return ColumnMap.from_row(first), chain([first], reader)
+
+
+def _sniff_dialect(sample):
+    try:
+        return csv.Sniffer().sniff(sample, DELIMITERS)
+    except csv.Error:
+        # a single column, or rows too ragged to tell: go by the delimiter
+        # the first line has most of
+        line = sample.split("\n", 1)[0]
+        count, delimiter = max([(line.count(c), c) for c in DELIMITERS])
+        dialect = csv.excel()
+        if count:
+            dialect.delimiter = delimiter
+        return dialect
+
+
+def _encoding(data):
+    """
+    The UTF-16 flavour ``data`` starts in, ``None`` for anything else.
+    """
+    if data[:2] in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+        return "utf-16"
+    # no BOM: text mostly ASCII has every other byte NUL
+    if data[1:2] == "\x00" and data[0:1] != "\x00":
+        return "utf-16-le"
+    if data[0:1] == "\x00" and data[1:2] != "\x00":
+        return "utf-16-be"
+    return None
+
+
+def _iter_lines(stream, chunk_size):
+    # lines are handed to the csv module with their line ending, so that
+    # quoted cells spanning lines are read right
+    decoder = None
+    pending = ""
+    first = True
+    while True:
+        data = stream.read(chunk_size)
+        if first:
+            first = False
+            encoding = _encoding(data)
+            if encoding is not None:
+                decoder = codecs.getincrementaldecoder(encoding)()
+            elif data.startswith(codecs.BOM_UTF8):
+                data = data[len(codecs.BOM_UTF8):]
+        if decoder is not None:
+            data = decoder.decode(data, not data).encode("utf-8")
+        if not data:
+            break
+        lines = (pending + data).splitlines(True)
+        pending = ""
+        # the last line may go on in the next chunk, and a CR be followed
+        # by an LF there
+        if not lines[-1].endswith("\n"):
+            pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def _cell_emails(cell):
+    emails = []
+    for token in SPLIT_RE.split(cell):
+        if "@" in token:
+            email = normalize_email(token.strip("<>\"'"))
+            if is_valid_email(email):
+                emails.append(_decode(email))
+    return emails
+
+
+def _decode(value):
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        return value.decode("cp1252", "replace")
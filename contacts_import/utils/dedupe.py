@@ -0,0 +1,135 @@
+"""
+Merges contacts that share an email address before they reach the
+persistance backend.
+
+Contacts are compared on a normalized email: lowercased and, optionally,
+with Gmail's dots and ``+tags`` folded away (``j.doe+news@gmail.com`` is
+``jdoe@gmail.com``). Within a chunk duplicates are merged into one contact
+whose name is picked according to the name policy. Across chunks only a
+digest of each key already passed on is remembered (16 bytes of its
+SHA-1), so a duplicate showing up in a later chunk is dropped rather than
+merged.
+
+Settings:
+
+    CONTACTS_IMPORT_DEDUPE              enable the merge stage (True)
+    CONTACTS_IMPORT_DEDUPE_FOLD_GMAIL   fold Gmail dots and tags (False)
+    CONTACTS_IMPORT_DEDUPE_NAME_POLICY  "first", "last" or "longest" name
+                                        wins ("longest")
+    CONTACTS_IMPORT_DEDUPE_MAX_KEYS     keys remembered across chunks
+                                        (1000000); past that, duplicates
+                                        are left to the database constraint
+"""
+
+import hashlib
+
+from django.conf import settings
+
+from contacts_import.utils.records import ContactChunk
+
+
+__all__ = ["ContactMerger", "email_key"]
+
+
+GMAIL_DOMAINS = frozenset(["gmail.com", "googlemail.com"])
+
+NAME_POLICIES = {
+    "first": lambda current, new: current or new,
+    "last": lambda current, new: new or current,
+    "longest": lambda current, new: len(new) > len(current) and new or current,
+}
+
+
+def email_key(email, fold_gmail=False):
+    email = email.strip().lower()
+    local, sep, domain = email.rpartition("@")
+    if not sep:
+        return email
+    if fold_gmail and domain in GMAIL_DOMAINS:
+        local = local.split("+", 1)[0].replace(".", "")
+        domain = "gmail.com"
+    return "%s@%s" % (local, domain)
+
+
+def _digest(key):
+    # unlike hash(), tells apart any two addresses that may turn up
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return hashlib.sha1(key).digest()[:16]
+
+
+class ContactMerger(object):
+    
+    def __init__(self, fold_gmail=False, name_policy="longest", max_keys=1000000):
+        if name_policy not in NAME_POLICIES:
+            raise ValueError("Unknown name policy '%s'" % name_policy)
+        self.fold_gmail = fold_gmail
+        self.pick_name = NAME_POLICIES[name_policy]
+        self.max_keys = max_keys
+        self.seen = set()
+        self.merged = 0
+    
+    @classmethod
+    def from_settings(cls):
+        if not getattr(settings, "CONTACTS_IMPORT_DEDUPE", True):
+            return None
+        return cls(
+            fold_gmail = getattr(settings, "CONTACTS_IMPORT_DEDUPE_FOLD_GMAIL", False),
+            name_policy = getattr(settings, "CONTACTS_IMPORT_DEDUPE_NAME_POLICY", "longest"),
+            max_keys = getattr(settings, "CONTACTS_IMPORT_DEDUPE_MAX_KEYS", 1000000),
+        )
+    
+    def merge(self, contacts):
+        """
+        Returns ``contacts`` less duplicates, in the order their email was
+        first seen; a ``ContactChunk`` if that is what was passed in.
+        ``merged`` counts the contacts dropped so far.
+        """
+        if isinstance(contacts, ContactChunk):
+            return self.merge_chunk(contacts)
+        index = {}
+        unique = []
+        for contact in contacts:
+            key = email_key(contact["email"], self.fold_gmail)
+            i = index.get(key)
+            if i is None:
+                if _digest(key) in self.seen:
+                    self.merged += 1
+                    continue
+                index[key] = len(unique)
+                unique.append(contact)
+                continue
+            self.merged += 1
+            kept = unique[i]
+            name = self.pick_name(kept["name"] or "", contact["name"] or "")
+            if name != kept["name"]:
+                unique[i] = kept = kept.copy()
+                kept["name"] = name
+        if len(self.seen) < self.max_keys:
+            self.seen.update(_digest(key) for key in index)
+        return unique
+    
+    def merge_chunk(self, chunk):
+        # the same as merge, on the columns of the chunk
+        index = {}
+        keep = []
+        names = []
+        for i, (email, name) in enumerate(chunk.pairs()):
+            key = email_key(email, self.fold_gmail)
+            j = index.get(key)
+            if j is None:
+                if _digest(key) in self.seen:
+                    self.merged += 1
+                    continue
+                index[key] = len(keep)
+                keep.append(i)
+                names.append(name)
+                continue
+            self.merged += 1
+            names[j] = self.pick_name(names[j] or "", name or "")
+        if len(self.seen) < self.max_keys:
+            self.seen.update(_digest(key) for key in index)
+        if len(keep) == len(chunk):
+            chunk.names = names
+            return chunk
+        return chunk.select(keep, names)
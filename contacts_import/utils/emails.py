@@ -0,0 +1,93 @@
+"""
+Tokenizer for pasted lists of email addresses. Usage::
+
+    >>> from contacts_import.utils.emails import iter_emails
+    >>> rejected = []
+    >>> list(iter_emails('Ada <ada@example.com>; bob@EXAMPLE.com, nope', rejected))
+    [ImportedContact('ada@example.com', 'Ada'), ImportedContact('bob@example.com', '')]
+    >>> rejected
+    [(1, 'nope', 'invalid')]
+
+Addresses may be separated by commas, semicolons, whitespace or newlines
+and may be written as ``addr``, ``Name <addr>`` or ``"Last, First" <addr>``.
+The text is scanned once with a single precompiled expression.
+"""
+
+import re
+
+from contacts_import.utils.records import ImportedContact
+
+
+__all__ = ["iter_emails", "normalize_email", "is_valid_email"]
+
+
+TOKEN_RE = re.compile(r"""
+    (?:"(?P<quoted>[^"\n]*)"|(?P<name>[^,;<>"@\n]*?))\s*<(?P<addr>[^<>\n]*)>
+    |(?P<bare>[^\s,;<>"]+)
+    |(?P<junk>[<>"][^\s,;]*)
+""", re.VERBOSE)
+
+# the same as Django's validator, less quoted local parts and IP domains
+EMAIL_RE = re.compile(
+    r"^[-!#$%&'*+/=?^_`{}|~0-9A-Z]+(\.[-!#$%&'*+/=?^_`{}|~0-9A-Z]+)*"
+    r"@(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,63}\.?$",
+    re.IGNORECASE
+)
+
+
+def is_valid_email(email):
+    return EMAIL_RE.match(email) is not None
+
+
+def normalize_email(email):
+    """
+    Strips a ``mailto:`` prefix and lowercases the domain; the local part
+    is left alone.
+    """
+    email = email.strip()
+    if email[:7].lower() == "mailto:":
+        email = email[7:]
+    local, sep, domain = email.rpartition("@")
+    if not sep:
+        return email
+    return "%s@%s" % (local, domain.lower().rstrip("."))
+
+
+def iter_emails(text, rejected=None):
+    """
+    Yields an ``ImportedContact`` for each valid address in ``text``,
+    skipping case-insensitive duplicates. If ``rejected`` is given, a
+    ``(line number, token, reason)`` tuple is appended to it for every
+    token that was skipped; ``reason`` is ``"invalid"`` or ``"duplicate"``.
+    """
+    seen = set()
+    line = 1
+    pos = 0
+    for match in TOKEN_RE.finditer(text):
+        line += text.count("\n", pos, match.start())
+        pos = match.start()
+        token = match.group(0).strip()
+        if match.group("junk") is not None:
+            if rejected is not None:
+                rejected.append((line, token, "invalid"))
+            continue
+        if match.group("addr") is not None:
+            email = match.group("addr")
+            name = match.group("quoted")
+            if name is None:
+                name = match.group("name")
+            name = name.strip()
+        else:
+            email, name = match.group("bare"), ""
+        email = normalize_email(email)
+        if not is_valid_email(email):
+            if rejected is not None:
+                rejected.append((line, token, "invalid"))
+            continue
+        key = email.lower()
+        if key in seen:
+            if rejected is not None:
+                rejected.append((line, token, "duplicate"))
+            continue
+        seen.add(key)
+        yield ImportedContact(email, name)
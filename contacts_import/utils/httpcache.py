@@ -0,0 +1,222 @@
+"""
+Opt-in cache for provider API responses, used by ``httppool`` for GET
+requests made on behalf of a user. A retried import, or a refreshed
+callback URL, is then answered without downloading the address book again.
+
+Responses are keyed by (provider, user, URL). ``Cache-Control`` is honored:
+``no-store`` responses are never kept, ``max-age`` sets how long one is
+fresh and ``no-cache`` makes it stale straight away. Stale responses that
+came with an ``ETag`` are revalidated with ``If-None-Match`` and served
+from the cache on a 304.
+
+Settings:
+
+    CONTACTS_IMPORT_HTTP_CACHE           False (off), "memory" for a per
+                                         process LRU or "django" for the
+                                         Django cache framework (False)
+    CONTACTS_IMPORT_HTTP_CACHE_ALIAS     Django cache to use ("default")
+    CONTACTS_IMPORT_HTTP_CACHE_MAX_SIZE  bytes kept by the in-process LRU;
+                                         larger responses are never cached
+                                         (33554432)
+    CONTACTS_IMPORT_HTTP_CACHE_TTL       seconds a response without max-age
+                                         is fresh (300)
+    CONTACTS_IMPORT_HTTP_CACHE_KEEP      seconds a stale response with an
+                                         ETag is kept for revalidation (3600)
+"""
+
+import hashlib
+import re
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+__all__ = ["LRUStore", "DjangoCacheStore", "ResponseCache", "get_cache"]
+
+
+MAX_AGE_RE = re.compile(r"max-age\s*=\s*(\d+)")
+
+
+class LRUStore(object):
+    """
+    Keeps entries in process up to ``max_size`` bytes of content, evicting
+    the least recently used first.
+    """
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+    
+    def get(self, key):
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is None:
+                return None
+            until, entry = item
+            if until < time.time():
+                self.size -= len(entry["content"])
+                return None
+            self.entries[key] = item
+            return entry
+    
+    def set(self, key, entry, timeout):
+        size = len(entry["content"])
+        if size > self.max_size:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1]["content"])
+            self.entries[key] = (time.time() + timeout, entry)
+            self.size += size
+            while self.size > self.max_size:
+                until, evicted = self.entries.popitem(last=False)[1]
+                self.size -= len(evicted["content"])
+                self.evictions += 1
+
+
+class DjangoCacheStore(object):
+    """
+    Keeps entries in a Django cache, shared by every process using it;
+    eviction is left to the cache backend.
+    """
+    
+    evictions = 0
+    
+    def __init__(self, alias="default", max_size=None):
+        try:
+            from django.core.cache import caches
+        except ImportError:
+            from django.core.cache import get_cache
+            self.cache = get_cache(alias)
+        else:
+            self.cache = caches[alias]
+        self.max_size = max_size
+    
+    def get(self, key):
+        return self.cache.get(key)
+    
+    def set(self, key, entry, timeout):
+        if self.max_size is not None and len(entry["content"]) > self.max_size:
+            return
+        self.cache.set(key, entry, int(timeout) + 1)
+
+
+class ResponseCache(object):
+    
+    def __init__(self, store, ttl=300, keep=3600):
+        self.store = store
+        self.ttl = ttl
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "revalidated": 0,
+            "stored": 0,
+        }
+    
+    def key(self, scope, url):
+        return "contacts_import:http:%s" % hashlib.md5("%s|%s" % (scope, url)).hexdigest()
+    
+    def request(self, fetch, url, headers, scope):
+        """
+        Answers a GET of ``url`` from the cache, calling
+        ``fetch(url, headers)`` when it has to go to the network.
+        """
+        key = self.key(scope, url)
+        entry = self.store.get(key)
+        if entry is not None and entry["expires"] > time.time():
+            self._count("hits")
+            return self._response(entry), entry["content"]
+        if entry is not None and entry["etag"]:
+            headers = dict(headers or {})
+            headers["If-None-Match"] = entry["etag"]
+        response, content = fetch(url, headers)
+        freshness = self.freshness(response)
+        if response.status == 304 and entry is not None:
+            self._count("revalidated")
+            self._count("hits")
+            if freshness is not None:
+                entry["expires"] = time.time() + freshness
+                self._store(key, entry)
+            return self._response(entry), entry["content"]
+        self._count("misses")
+        if response.status == 200 and freshness is not None:
+            self._store(key, {
+                "headers": dict(response),
+                "content": content,
+                "etag": response.get("etag"),
+                "expires": time.time() + freshness,
+            })
+        return response, content
+    
+    def freshness(self, response):
+        """
+        Seconds ``response`` may be served without revalidation, ``None``
+        if it must not be stored.
+        """
+        control = response.get("cache-control", "").lower()
+        if "no-store" in control:
+            return None
+        if "no-cache" in control:
+            return 0
+        match = MAX_AGE_RE.search(control)
+        if match:
+            return int(match.group(1))
+        return self.ttl
+    
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["evictions"] = self.store.evictions
+        return stats
+    
+    def _store(self, key, entry):
+        timeout = entry["expires"] - time.time()
+        if entry["etag"]:
+            timeout += self.keep
+        if timeout <= 0:
+            return
+        self.store.set(key, entry, timeout)
+        self._count("stored")
+    
+    def _response(self, entry):
+        from httplib2 import Response
+        response = Response(entry["headers"])
+        response.fromcache = True
+        return response
+    
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+
+def get_cache():
+    """
+    The ``ResponseCache`` configured in settings, ``None`` if caching is off.
+    """
+    kind = getattr(settings, "CONTACTS_IMPORT_HTTP_CACHE", False)
+    if not kind:
+        return None
+    max_size = getattr(settings, "CONTACTS_IMPORT_HTTP_CACHE_MAX_SIZE", 32 * 1024 * 1024)
+    if kind == "memory":
+        store = LRUStore(max_size)
+    elif kind == "django":
+        store = DjangoCacheStore(
+            getattr(settings, "CONTACTS_IMPORT_HTTP_CACHE_ALIAS", "default"),
+            max_size,
+        )
+    else:
+        raise ImproperlyConfigured("Unknown CONTACTS_IMPORT_HTTP_CACHE '%s'" % kind)
+    return ResponseCache(store,
+        ttl = getattr(settings, "CONTACTS_IMPORT_HTTP_CACHE_TTL", 300),
+        keep = getattr(settings, "CONTACTS_IMPORT_HTTP_CACHE_KEEP", 60 * 60),
+    )
@@ -0,0 +1,182 @@
+"""
+Process wide pool of keep-alive HTTP connections. Usage::
+
+    >>> from contacts_import.utils import httppool
+    >>> response, content = httppool.request(url, headers=headers)
+
+Idle ``httplib2.Http`` instances are kept per host and handed out again,
+so consecutive calls to the same provider reuse an open connection instead
+of paying for a new TCP (and TLS) handshake each time. ``httplib2.Http``
+itself isn't thread safe; the pool makes sure each instance is only used
+by one thread at a time.
+
+GET requests made with a ``cache_scope`` (the provider and user they are
+made for) may be answered from the response cache, see ``httpcache``.
+
+Settings:
+
+    CONTACTS_IMPORT_HTTP_TIMEOUT       socket timeout in seconds (30)
+    CONTACTS_IMPORT_HTTP_RETRIES       retries for idempotent requests (2)
+    CONTACTS_IMPORT_HTTP_MAX_PER_HOST  concurrent connections per host (4,
+                                       or the concurrency of the runner if
+                                       it is higher)
+    CONTACTS_IMPORT_HTTP_BACKOFF       seconds to wait before the first retry,
+                                       doubled for each further one (0.25)
+"""
+
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+from django.conf import settings
+
+from contacts_import.utils import httpcache
+
+
+__all__ = ["HttpPool", "get_pool", "request", "stats"]
+
+
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+
+class HttpPool(object):
+    
+    def __init__(self, max_per_host=4, timeout=30, retries=2, cache=None, backoff=0.25):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+        self.counters = {
+            "requests": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "retries": 0,
+            "errors": 0,
+            "bytes": 0,
+        }
+    
+    def request(self, url, method="GET", body=None, headers=None, cache_scope=None):
+        if self.cache is not None and cache_scope is not None and method.upper() == "GET":
+            # a conditional request is the caller's own business
+            if "If-None-Match" not in (headers or {}):
+                return self.cache.request(self._fetch, url, headers, cache_scope)
+        return self._fetch(url, headers, method, body)
+    
+    def _fetch(self, url, headers, method="GET", body=None):
+        scheme, authority = urlparse.urlsplit(url)[:2]
+        # the key httplib2 uses for its own connection cache
+        host = "%s:%s" % (scheme, authority)
+        slot, http = self._checkout(host)
+        try:
+            return self._request(http, host, url, method, body, headers)
+        finally:
+            self._checkin(host, slot, http)
+    
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        if self.cache is not None:
+            for name, value in self.cache.stats().iteritems():
+                stats["cache_%s" % name] = value
+        return stats
+    
+    def _request(self, http, host, url, method, body, headers):
+        from httplib2 import HttpLib2Error
+        attempts = 1
+        if method.upper() in IDEMPOTENT_METHODS:
+            attempts += self.retries
+        for attempt in xrange(attempts):
+            if attempt:
+                self._count("retries")
+                if self.backoff:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+            reused = host in http.connections
+            try:
+                response, content = http.request(url, method,
+                    body = body,
+                    headers = headers,
+                )
+            except (socket.error, httplib.HTTPException, HttpLib2Error):
+                self._count("errors")
+                self._reset(http)
+                if attempt + 1 == attempts:
+                    raise
+                continue
+            self._count("connections_reused" if reused else "connections_created")
+            self._count("requests")
+            self._count("bytes", len(content))
+            if response.status in RETRY_STATUSES and attempt + 1 < attempts:
+                continue
+            return response, content
+    
+    def _checkout(self, host):
+        with self.lock:
+            slot = self.slots.get(host)
+            if slot is None:
+                slot = self.slots[host] = threading.BoundedSemaphore(self.max_per_host)
+        slot.acquire()
+        with self.lock:
+            idle = self.idle.setdefault(host, [])
+            if idle:
+                return slot, idle.pop()
+        # httplib2 is imported by the first request rather than with the app
+        import httplib2
+        return slot, httplib2.Http(timeout=self.timeout)
+    
+    def _checkin(self, host, slot, http):
+        with self.lock:
+            self.idle[host].append(http)
+        slot.release()
+    
+    def _reset(self, http):
+        for conn in http.connections.values():
+            conn.close()
+        http.connections.clear()
+    
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _max_per_host():
+    from contacts_import.settings import get_runner
+    # as many connections as there may be imports from one provider
+    return max(4, getattr(get_runner(), "concurrency", 1))
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = HttpPool(
+                    max_per_host = getattr(settings, "CONTACTS_IMPORT_HTTP_MAX_PER_HOST", None) or _max_per_host(),
+                    timeout = getattr(settings, "CONTACTS_IMPORT_HTTP_TIMEOUT", 30),
+                    retries = getattr(settings, "CONTACTS_IMPORT_HTTP_RETRIES", 2),
+                    cache = httpcache.get_cache(),
+                    backoff = getattr(settings, "CONTACTS_IMPORT_HTTP_BACKOFF", 0.25),
+                )
+    return _pool
+
+
+def request(url, method="GET", body=None, headers=None, cache_scope=None):
+    return get_pool().request(url, method,
+        body = body,
+        headers = headers,
+        cache_scope = cache_scope,
+    )
+
+
+def stats():
+    return get_pool().stats()
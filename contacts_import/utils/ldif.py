@@ -0,0 +1,119 @@
+"""
+Streaming LDIF reader, for address books exported by Thunderbird, Apple
+Contacts and LDAP directories. Usage::
+
+    >>> from StringIO import StringIO
+    >>> from contacts_import.utils.ldif import iter_ldif_contacts
+    >>> list(iter_ldif_contacts(StringIO(
+    ...     "dn: cn=Ada Lovelace,mail=ada@example.com\\n"
+    ...     "cn: Ada Lovelace\\n"
+    ...     "mail: ada@example.com\\n"
+    ... )))
+    [(u'Ada Lovelace', [u'ada@example.com'])]
+
+Entries are read one at a time and only the name and mail attributes are
+kept: ``cn`` or ``displayName`` (or ``givenName`` and ``sn``) for the name,
+``mail`` and ``mozillaSecondEmail`` for the addresses. Folded lines and
+base64 values (``attr:: ...``) are handled; URL values (``attr:< ...``)
+are skipped.
+"""
+
+import base64
+import binascii
+
+from contacts_import.utils.emails import is_valid_email, normalize_email
+from contacts_import.utils.vcard import _iter_physical_lines
+
+
+__all__ = ["iter_ldif_contacts"]
+
+
+CHUNK_SIZE = 64 * 1024
+
+NAME_ATTRIBUTES = ("cn", "displayname")
+NAME_PART_ATTRIBUTES = ("givenname", "sn")
+EMAIL_ATTRIBUTES = ("mail", "mozillasecondemail")
+
+WANTED_ATTRIBUTES = frozenset(NAME_ATTRIBUTES + NAME_PART_ATTRIBUTES + EMAIL_ATTRIBUTES)
+
+
+def iter_ldif_contacts(stream, chunk_size=CHUNK_SIZE):
+    """
+    Yields a ``(name, emails)`` tuple for each entry of ``stream`` with at
+    least one valid address; ``name`` may be empty.
+    """
+    entry = {}
+    for attr, value in _iter_attributes(stream, chunk_size):
+        if attr is None:
+            contact = _contact(entry)
+            if contact is not None:
+                yield contact
+            entry = {}
+        else:
+            entry.setdefault(attr, []).append(value)
+    contact = _contact(entry)
+    if contact is not None:
+        yield contact
+
+
+def _contact(entry):
+    emails = []
+    for attr in EMAIL_ATTRIBUTES:
+        for value in entry.get(attr, ()):
+            email = normalize_email(value)
+            if is_valid_email(email) and email not in emails:
+                emails.append(email)
+    if not emails:
+        return None
+    for attr in NAME_ATTRIBUTES:
+        if entry.get(attr):
+            name = entry[attr][0]
+            break
+    else:
+        name = " ".join([entry[attr][0] for attr in NAME_PART_ATTRIBUTES if entry.get(attr)])
+    return name.strip(), emails
+
+
+def _iter_attributes(stream, chunk_size):
+    """
+    Yields ``(attribute, value)`` for every wanted attribute, lowercased and
+    decoded, and ``(None, None)`` at the end of each entry.
+    """
+    line = None
+    for physical in _iter_physical_lines(stream, chunk_size):
+        if physical[:1] == " ":
+            if line is not None:
+                line += physical[1:]
+            continue
+        if line is not None:
+            attribute = _parse(line)
+            if attribute is not None:
+                yield attribute
+            line = None
+        if not physical:
+            yield None, None
+        elif physical[:1] != "#":
+            line = physical
+    if line is not None:
+        attribute = _parse(line)
+        if attribute is not None:
+            yield attribute
+
+
+def _parse(line):
+    attr, sep, value = line.partition(":")
+    if not sep:
+        return None
+    # options such as "cn;lang-en" don't matter here
+    attr = attr.split(";", 1)[0].strip().lower()
+    if attr not in WANTED_ATTRIBUTES:
+        return None
+    if value[:1] == ":":
+        try:
+            value = base64.b64decode(value[1:].strip())
+        except (TypeError, binascii.Error):
+            return None
+    elif value[:1] == "<":
+        return None
+    return attr, value.strip().decode("utf-8", "replace")
+
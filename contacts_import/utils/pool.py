@@ -0,0 +1,128 @@
+"""
+A small thread pool. Python 2 has no ``concurrent.futures`` so this
+provides the little we need of it: ``WorkerPool.submit`` returning a
+``Future``, and ``prefetch`` for running a few calls ahead of a consumer.
+"""
+
+import Queue
+import sys
+import threading
+
+from collections import deque
+from itertools import islice
+
+
+__all__ = ["PoolFull", "Future", "WorkerPool", "get_pool", "prefetch"]
+
+
+class PoolFull(Exception):
+    pass
+
+
+class Future(object):
+    
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+    
+    def done(self):
+        return self._done.is_set()
+    
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("Result not available yet")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+    
+    def exception(self):
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+    
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+    
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+
+class WorkerPool(object):
+    """
+    Runs submitted calls on at most ``workers`` daemon threads, started on
+    demand. ``queue_size`` bounds the number of calls waiting for a thread
+    (0 means unbounded); ``submit`` raises ``PoolFull`` past it.
+    """
+    
+    def __init__(self, workers, queue_size=0):
+        self.workers = workers
+        self.queue = Queue.Queue(queue_size)
+        self.threads = []
+        self.lock = threading.Lock()
+    
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        try:
+            self.queue.put((future, func, args, kwargs), block=False)
+        except Queue.Full:
+            raise PoolFull()
+        self._start_worker()
+        return future
+    
+    def pending(self):
+        return self.queue.qsize()
+    
+    def _start_worker(self):
+        with self.lock:
+            if len(self.threads) >= self.workers:
+                return
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+    
+    def _work(self):
+        while True:
+            future, func, args, kwargs = self.queue.get()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+            # don't keep the last job alive while waiting for the next one
+            del future, func, args, kwargs
+            result = None
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name, workers, queue_size=0):
+    """
+    Returns the process wide pool called ``name``, creating it on first use.
+    """
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = WorkerPool(workers, queue_size)
+        return _pools[name]
+
+
+def prefetch(pool, func, items, depth):
+    """
+    Yields ``func(item)`` for each of ``items``, in order, while keeping up
+    to ``depth`` calls running ahead on ``pool``. Nothing more is submitted
+    until the consumer asks for the next result.
+    """
+    items = iter(items)
+    pending = deque(pool.submit(func, item) for item in islice(items, depth))
+    while pending:
+        future = pending.popleft()
+        result = future.result()
+        for item in islice(items, 1):
+            pending.append(pool.submit(func, item))
+        yield result
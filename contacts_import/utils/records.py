@@ -0,0 +1,184 @@
+"""
+Compact containers for contacts on their way from an importer to a
+persistance backend.
+
+``ImportedContact`` is a two slot record used in place of an
+``{"email", "name"}`` dict; it supports the read and write operations of
+such a dict, so backends written against dicts keep working.
+``ContactChunk`` holds a chunk of contacts column wise: the local part and
+domain of each email and the names in parallel lists, with one copy of
+each distinct domain per chunk. Backends that can work on columns use
+``ContactChunk.pairs``; iterating a chunk yields ``ImportedContact``\s.
+"""
+
+
+__all__ = ["ImportedContact", "ContactChunk", "chunked_contacts"]
+
+
+FIELDS = ("email", "name")
+
+
+class ImportedContact(object):
+    
+    __slots__ = FIELDS
+    
+    def __init__(self, email, name=""):
+        self.email = email
+        self.name = name
+    
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __setitem__(self, key, value):
+        if key not in FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+    
+    def get(self, key, default=None):
+        if key not in FIELDS:
+            return default
+        return getattr(self, key)
+    
+    def __contains__(self, key):
+        return key in FIELDS
+    
+    def __iter__(self):
+        return iter(FIELDS)
+    
+    def __len__(self):
+        return len(FIELDS)
+    
+    def keys(self):
+        return list(FIELDS)
+    
+    def values(self):
+        return [self.email, self.name]
+    
+    def items(self):
+        return [("email", self.email), ("name", self.name)]
+    
+    def copy(self):
+        return ImportedContact(self.email, self.name)
+    
+    def as_dict(self):
+        return {"email": self.email, "name": self.name}
+    
+    def __eq__(self, other):
+        try:
+            return self.email == other["email"] and self.name == other["name"] and len(other) == 2
+        except (KeyError, TypeError):
+            return False
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    __hash__ = None
+    
+    def __reduce__(self):
+        return (ImportedContact, (self.email, self.name))
+    
+    def __repr__(self):
+        return "ImportedContact(%r, %r)" % (self.email, self.name)
+
+
+class ContactChunk(object):
+    
+    def __init__(self, contacts=()):
+        self.locals = []
+        self.domains = []
+        self.names = []
+        self._domains = {}
+        self.extend(contacts)
+    
+    def append(self, email, name=""):
+        local, sep, domain = email.rpartition("@")
+        if not sep:
+            local, domain = email, None
+        else:
+            domain = self._domains.setdefault(domain, domain)
+        self.locals.append(local)
+        self.domains.append(domain)
+        self.names.append(name)
+    
+    def extend(self, contacts):
+        if isinstance(contacts, ContactChunk):
+            self.locals.extend(contacts.locals)
+            self.domains.extend([
+                domain if domain is None else self._domains.setdefault(domain, domain)
+                for domain in contacts.domains
+            ])
+            self.names.extend(contacts.names)
+            return
+        for contact in contacts:
+            self.append(contact["email"], contact["name"])
+    
+    def select(self, indices, names=None):
+        """
+        A chunk of the contacts at ``indices``, optionally renamed.
+        """
+        chunk = ContactChunk()
+        chunk.locals = [self.locals[i] for i in indices]
+        chunk.domains = [self.domains[i] for i in indices]
+        chunk.names = names if names is not None else [self.names[i] for i in indices]
+        chunk._domains = self._domains
+        return chunk
+    
+    def email(self, i):
+        domain = self.domains[i]
+        if domain is None:
+            return self.locals[i]
+        return "%s@%s" % (self.locals[i], domain)
+    
+    def emails(self):
+        return [self.email(i) for i in xrange(len(self.locals))]
+    
+    def pairs(self):
+        """
+        Yields ``(email, name)`` for each contact, without building records.
+        """
+        for i in xrange(len(self.locals)):
+            yield self.email(i), self.names[i]
+    
+    def __len__(self):
+        return len(self.locals)
+    
+    def __iter__(self):
+        for email, name in self.pairs():
+            yield ImportedContact(email, name)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            chunk = ContactChunk()
+            chunk.locals = self.locals[index]
+            chunk.domains = self.domains[index]
+            chunk.names = self.names[index]
+            chunk._domains = self._domains
+            return chunk
+        return ImportedContact(self.email(index), self.names[index])
+    
+    def __getstate__(self):
+        return (self.locals, self.domains, self.names)
+    
+    def __setstate__(self, state):
+        self.locals, self.domains, self.names = state
+        self._domains = dict((domain, domain) for domain in self.domains if domain is not None)
+
+
+def chunked_contacts(contacts, size):
+    """
+    Yields ``ContactChunk``\s of at most ``size`` of ``contacts``, consuming
+    no more of them than needed.
+    """
+    chunk = ContactChunk()
+    for contact in contacts:
+        if contact.__class__ is ImportedContact:
+            chunk.append(contact.email, contact.name)
+        else:
+            chunk.append(contact["email"], contact["name"])
+        if len(chunk.locals) >= size:
+            yield chunk
+            chunk = ContactChunk()
+    if chunk.locals:
+        yield chunk
@@ -0,0 +1,53 @@
+"""
+Keeps uploaded address books out of Celery messages. ``stage`` saves the
+``stream`` of an import to ``default_storage`` and replaces it with the
+name it was saved under; the worker opens it again with ``unstage`` and
+deletes it with ``discard`` once the import is over. The storage must be
+reachable from the workers (a shared filesystem or a remote storage).
+
+Settings:
+
+    CONTACTS_IMPORT_STAGE_THRESHOLD  strings longer than this are staged
+                                     too (65536); files always are
+    CONTACTS_IMPORT_STAGE_DIR        storage directory ("contacts_import")
+"""
+
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+
+STAGE_THRESHOLD = getattr(settings, "CONTACTS_IMPORT_STAGE_THRESHOLD", 64 * 1024)
+STAGE_DIR = getattr(settings, "CONTACTS_IMPORT_STAGE_DIR", "contacts_import")
+
+
+def stage(credentials):
+    stream = credentials.get("stream")
+    if hasattr(stream, "read"):
+        content = File(stream)
+    elif isinstance(stream, basestring) and len(stream) > STAGE_THRESHOLD:
+        if isinstance(stream, unicode):
+            stream = stream.encode("utf-8")
+        content = ContentFile(stream)
+    else:
+        return credentials
+    credentials = dict(credentials)
+    del credentials["stream"]
+    credentials["staged_stream"] = default_storage.save(
+        "%s/%s" % (STAGE_DIR, uuid.uuid4().hex), content
+    )
+    return credentials
+
+
+def unstage(credentials):
+    credentials = dict(credentials)
+    credentials["stream"] = default_storage.open(credentials["staged_stream"])
+    return credentials
+
+
+def discard(credentials):
+    credentials["stream"].close()
+    default_storage.delete(credentials["staged_stream"])
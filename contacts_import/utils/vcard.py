@@ -0,0 +1,173 @@
+"""
+Streaming vCard reader. Usage::
+
+    >>> from contacts_import.utils.vcard import iter_vcards
+    >>> for name, emails in iter_vcards(open("contacts.vcf")):
+    ...     pass
+
+Only ``FN`` and ``EMAIL`` are extracted. The stream is read ``chunk_size``
+bytes at a time and lines are unfolded as they come in; every other
+property (``PHOTO`` and friends included) is skipped without being joined
+or decoded, so memory use does not grow with the size of the file.
+
+Handles vCard 2.1 (quoted-printable soft line breaks, unindented base64
+blocks) as well as 3.0 and 4.0 line folding.
+"""
+
+import quopri
+
+
+__all__ = ["iter_vcards"]
+
+
+CHUNK_SIZE = 64 * 1024
+
+WANTED_PROPERTIES = frozenset(["BEGIN", "END", "FN", "EMAIL"])
+
+
+def iter_vcards(stream, chunk_size=CHUNK_SIZE):
+    """
+    Yields a ``(name, emails)`` tuple for each card in ``stream``. ``name``
+    is ``None`` when the card has no ``FN``.
+    """
+    depth = 0
+    name, emails = None, []
+    for prop, params, value in _iter_properties(stream, chunk_size):
+        if prop == "BEGIN":
+            if value.strip().upper() == "VCARD":
+                depth += 1
+                if depth == 1:
+                    name, emails = None, []
+        elif prop == "END":
+            if value.strip().upper() == "VCARD" and depth:
+                depth -= 1
+                if depth == 0:
+                    yield name, emails
+        elif depth == 1:
+            # properties of nested cards (AGENT) are ignored
+            value = _decode(value, params)
+            if prop == "FN":
+                name = _unescape(value).strip() or None
+            elif prop == "EMAIL":
+                value = value.strip()
+                if value:
+                    emails.append(value)
+
+
+def _iter_physical_lines(stream, chunk_size):
+    pending = ""
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        lines = (pending + data).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.endswith("\r"):
+                line = line[:-1]
+            yield line
+    if pending:
+        yield pending.rstrip("\r")
+
+
+def _iter_properties(stream, chunk_size):
+    """
+    Yields ``(name, params, raw value)`` for every wanted property, with
+    continuation lines already joined.
+    """
+    parts = None
+    params = None
+    prop = None
+    skipping = False
+    # vCard 2.1 base64 blocks may continue on unindented lines up to a
+    # blank line; base64 never contains ":" which sets them apart
+    base64_block = False
+    soft_break = False
+    for line in _iter_physical_lines(stream, chunk_size):
+        if line[:1] in (" ", "\t"):
+            if parts is not None and not skipping:
+                if soft_break:
+                    parts[-1] = parts[-1][:-1]
+                parts.append(line[1:])
+                soft_break = "QUOTED-PRINTABLE" in params and line.endswith("=")
+            continue
+        if soft_break:
+            parts[-1] = parts[-1][:-1]
+            parts.append(line)
+            soft_break = line.endswith("=")
+            continue
+        if base64_block:
+            if line and ":" not in line:
+                continue
+            base64_block = False
+        if parts is not None:
+            yield prop, params, "".join(parts)
+            parts = None
+        if not line:
+            continue
+        head, sep, value = _split_property(line)
+        if not sep:
+            # garbage, or the tail of something we could not make sense of
+            skipping = True
+            continue
+        fields = head.split(";")
+        prop = fields[0].rsplit(".", 1)[-1].strip().upper()
+        if prop not in WANTED_PROPERTIES:
+            skipping = True
+            encoding = head.upper()
+            base64_block = "BASE64" in encoding or "ENCODING=B" in encoding
+            continue
+        skipping = False
+        params = [field.strip().upper() for field in fields[1:]]
+        if "ENCODING=QUOTED-PRINTABLE" in params:
+            params.append("QUOTED-PRINTABLE")
+        parts = [value]
+        soft_break = "QUOTED-PRINTABLE" in params and value.endswith("=")
+    if parts is not None:
+        yield prop, params, "".join(parts)
+
+
+def _split_property(line):
+    i = line.find(":")
+    if i == -1:
+        return line, "", ""
+    if '"' in line[:i]:
+        # a parameter value is quoted and may itself contain ":"
+        quoted = False
+        for i, c in enumerate(line):
+            if c == '"':
+                quoted = not quoted
+            elif c == ":" and not quoted:
+                break
+        else:
+            return line, "", ""
+    return line[:i], ":", line[i+1:]
+
+
+def _decode(value, params):
+    if "QUOTED-PRINTABLE" in params:
+        value = quopri.decodestring(value)
+    charset = "utf-8"
+    for param in params:
+        if param.startswith("CHARSET="):
+            charset = param[8:].strip('"')
+    if isinstance(value, str):
+        try:
+            value = value.decode(charset, "replace")
+        except LookupError:
+            value = value.decode("utf-8", "replace")
+    return value
+
+
+def _unescape(value):
+    if "\\" not in value:
+        return value
+    out = []
+    chars = iter(value)
+    for c in chars:
+        if c == "\\":
+            c = next(chars, "")
+            if c in ("n", "N"):
+                c = " "
+        out.append(c)
+    return "".join(out)
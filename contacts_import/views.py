@@ -1,27 +1,38 @@
-from gdata.contacts.service import ContactsService
-
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import redirect, render_to_response
 from django.template import RequestContext
+from django.utils import simplejson as json
+from django.utils.functional import lazy
 from django.utils.translation import ugettext as _
 
-from .backends.importers import GoogleImporter, YahooImporter
+from .backends.registry import get_importer, providers
 from .forms import VcardImportForm, EmailListImportForm
 from .models import TransientContact
-from .settings import RUNNER, CALLBACK
+from .progress import get_progress
+from .selection import ContactSelection
+from .settings import get_callback, get_runner, import_attr
+
+
+PAGE_SIZE = getattr(settings, "CONTACTS_IMPORT_PAGE_SIZE", 50)
+
+
+LOGIN_URLS_SESSION_KEY = "contacts_import_login_urls"
 
-def _import_success(request, results):
+
+def _import_success(request, results, redirect_to=None):
     if results.ready():
         if results.status == "DONE":
             messages.success(request,
                              _("%(total)s people with email found, %(imported)s "
                                "contacts imported.") % results.result
                              )
+            if results.result.get("rejected"):
+                _warn_rejected(request, results.result["rejected"],
+                               results.result["rejected_count"])
         elif results.status == "FAILURE":
             messages.error(request,
                            _("There was an error importing your contacts.")
@@ -33,54 +44,197 @@ def _import_success(request, results):
                         "shouldn't take too long.")
                       )
         request.session["import_contacts_task_id"] = results.task_id
-    return HttpResponseRedirect(request.path)
+    return HttpResponseRedirect(redirect_to or request.path)
 
-@login_required
-def import_email_list(request,
-                      template_name="contacts_import/import_email_list.html",
-                      next='select_contacts'):
+def _warn_rejected(request, rejected, count=None):
+    messages.warning(request,
+                     _("%(count)s entries were skipped: %(entries)s") % {
+                         "count": count or len(rejected),
+                         "entries": ", ".join([
+                             _("line %(line)s: %(token)s (%(reason)s)") % {
+                                 "line": line,
+                                 "token": token,
+                                 "reason": reason,
+                             }
+                             for line, token, reason in rejected[:10]
+                         ]),
+                     })
+
+def _page_param(request, name):
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError):
+        return None
+
+def _contacts_page(request):
     """
-    Given a comma-separated list, import email adresses
+    The page of imported contacts following ``?after=<pk>`` or preceding
+    ``?before=<pk>``; page ``?page=<n>`` if neither is given.
     """
-    email_form = EmailListImportForm(request.POST or None)
+    return TransientContact.objects.page_for(request.user, PAGE_SIZE,
+        after = _page_param(request, "after"),
+        before = _page_param(request, "before"),
+        number = _page_param(request, "page"),
+    )
 
-    if request.method == 'POST':
-        if email_form.is_valid():
-            results = email_form.save(request.user, runner_class=RUNNER)
-            return _import_success(request, results)
+def _login_url(request, provider):
+    """
+    The login URL of ``provider``, worked out once per session.
+    """
+    urls = request.session.get(LOGIN_URLS_SESSION_KEY, {})
+    if provider not in urls:
+        url = get_importer(provider)().login_url(request)
+        # gdata hands back an atom.url.Url, keep the session to strings
+        urls[provider] = url if url is None else unicode(url)
+        request.session[LOGIN_URLS_SESSION_KEY] = urls
+    return urls[provider]
 
-    context = {'email_form': email_form}
+def _forget_login_url(request, provider):
+    urls = request.session.get(LOGIN_URLS_SESSION_KEY, {})
+    if provider in urls:
+        del urls[provider]
+        request.session[LOGIN_URLS_SESSION_KEY] = urls
 
+
+class _LoginUrls(object):
+    """
+    The login URLs of the providers for templates, ``{{ login_urls.google }}``;
+    only those a template asks for are worked out.
+    """
+    
+    def __init__(self, request):
+        self.request = request
+    
+    def __getitem__(self, provider):
+        if provider not in providers():
+            raise KeyError(provider)
+        return _login_url(self.request, provider)
+
+
+def _bound_form(request, importer):
+    """
+    The form asking for the credentials of ``importer``, bound on a POST;
+    ``None`` for providers that need a login instead.
+    """
+    if importer.form is None:
+        return None
+    form_class = import_attr(importer.form)
+    if request.method == "POST":
+        return form_class(request.POST, request.FILES)
+    return form_class()
+
+def _session_credentials(request, importer):
+    keys = importer.credential_keys
+    if not keys or [key for key in keys if key not in request.session]:
+        return None
+    return dict((key, request.session.pop(key)) for key in keys)
+
+def _start_import(request, importer, form, runner_class):
+    """
+    Starts an import from ``importer`` with what was entered in ``form``,
+    or with the credentials its login left in the session. Returns the
+    results, ``None`` if there is nothing to import with (yet).
+    """
+    if form is not None:
+        if not form.is_valid():
+            return None
+        if getattr(form, "rejected", None):
+            _warn_rejected(request, form.rejected)
+        return form.save(request.user, runner_class=runner_class)
+    credentials = _session_credentials(request, importer)
+    if credentials is None:
+        return None
+    runner = runner_class(importer, user=request.user, **credentials)
+    return runner.import_contacts()
+
+
+@login_required
+def import_from(request, provider, template_name=None, form_name="form"):
+    """
+    Imports contacts from any registered provider: from what was entered in
+    its form, or with the credentials its login left in the session; users
+    that have yet to log in are sent to the provider first.
+    
+    The form is rendered with ``contacts_import/import_<provider>.html``,
+    or ``contacts_import/import_form.html`` if the project has no template
+    for the provider, unless ``template_name`` is given.
+    """
+    try:
+        importer = get_importer(provider)
+    except KeyError:
+        raise Http404
+    form = _bound_form(request, importer)
+    
+    if form is None:
+        results = _start_import(request, importer, None, get_runner())
+        if results is not None:
+            return _import_success(request, results, reverse("select_contacts"))
+        login_url = _login_url(request, provider)
+        if login_url is None:
+            return redirect("import_contacts")
+        return HttpResponseRedirect(login_url)
+    
+    if request.method == "POST":
+        results = _start_import(request, importer, form, get_runner())
+        if results is not None:
+            return _import_success(request, results)
+    
+    if template_name is None:
+        template_name = [
+            "contacts_import/import_%s.html" % provider,
+            "contacts_import/import_form.html",
+        ]
+    context = {form_name: form, "provider": provider}
+    
     return render_to_response(template_name,
                               RequestContext(request, context)
                               )
-                              
-    
 
 @login_required
-def import_google_contacts(request):
+def import_callback(request, provider):
     """
-    Import contacts from a Gmail account
+    Where a provider sends users back to once they logged in.
     """
-    gi = GoogleImporter()
-    gi.login_callback(request)
+    try:
+        importer = get_importer(provider)
+    except KeyError:
+        raise Http404
+    importer().login_callback(request)
+    # a login URL may only be good for one login
+    _forget_login_url(request, provider)
+    
+    results = _start_import(request, importer, None, get_runner())
+    if results is None:
+        messages.error(request, _("We could not get access to your contacts."))
+        return redirect("import_contacts")
+    return _import_success(request, results, reverse("select_contacts"))
 
-    gi.import_contacts(request)
+def import_email_list(request,
+                      template_name="contacts_import/import_email_list.html",
+                      next='select_contacts'):
+    """
+    Given a comma-separated list, import email adresses
+    """
+    return import_from(request, "email_list", template_name, form_name="email_form")
 
-    return redirect('select_contacts')
+def import_google_contacts(request):
+    """
+    Import contacts from a Gmail account
+    """
+    return import_callback(request, "google")
 
 @login_required
 def import_contacts(request, template_name="contacts_import/import_contacts.html"):
     """
     Generic view that gives access to all backend
     """
-    gi = GoogleImporter()
-
     email_list_form = EmailListImportForm(request.POST or None)
 
-    ctx = {"google_url" : gi.login_url(request),
+    ctx = {"login_urls" : _LoginUrls(request),
            "email_list_form" : email_list_form
            }
+    if "google" in providers():
+        ctx["google_url"] = lazy(_login_url, unicode)(request, "google")
 
     return render_to_response(template_name, 
                               RequestContext(request, ctx))
@@ -88,90 +242,92 @@ def import_contacts(request, template_name="contacts_import/import_contacts.html
 
 @login_required
 def select_contacts(request, template_name="contacts_import/select_contacts.html"):
-    contacts = request.user.imported_contacts.all()
-    context = {'contacts': contacts}
+    page = _contacts_page(request)
+    context = {'contacts': page.object_list,
+               'page': page}
     return render_to_response(template_name, 
                               RequestContext(request, context))
     
 
+@login_required
+def import_status(request, task_id):
+    """
+    Reports the progress of an asynchronous import as JSON; meant to be
+    polled instead of reloading the contacts page.
+    """
+    progress = get_progress(task_id)
+    if progress is None or progress.pop("owner") != request.user.pk:
+        raise Http404
+    return HttpResponse(json.dumps(progress), mimetype="application/json")
+
+
 @login_required
 def import_contacts_old(request, template_name="contacts_import/import_contacts.html"):
-    runner_class = RUNNER
-    callback = CALLBACK
+    runner_class = get_runner()
+    callback = get_callback()
     
-    contacts = request.user.imported_contacts.all()
-    try:
-        page_num = int(request.GET.get("page", 1))
-    except ValueError:
-        page_num = 1
-    page = Paginator(contacts, 50).page(page_num)
+    page = _contacts_page(request)
+    form = None
     
     if request.method == "POST":
         action = request.POST["action"]
         
-        if action == "upload_vcard":
-            form = VcardImportForm(request.POST, request.FILES)
+        if action == "import-contacts":
+            selected = ContactSelection.for_session(request.session)
+            if "select_all" in request.POST:
+                selected.select([o.pk for o in page.object_list])
+            elif "select_none" in request.POST:
+                selected.deselect([o.pk for o in page.object_list])
+            else:
+                selected.update_page(
+                    [o.pk for o in page.object_list],
+                    request.POST.getlist("selected-contacts")
+                )
+            selected.save(request.session)
             
-            if form.is_valid():
-                results = form.save(request.user, runner_class=runner_class)
-                return _import_success(request, results)
-        
-        elif action == "import-contacts":
-            selected_post = set(request.POST.getlist("selected-contacts"))
-            selected_session = request.session.get("selected-contacts", set())
-            on_page = set([str(o.pk) for o in page.object_list])
-            selected = (
-                (selected_session - (on_page - selected_post)).union(selected_post)
-            )
-            request.session["selected-contacts"] = selected
-            
-            if "next" in request.POST:
-                return HttpResponseRedirect("%s?page=%s" % (request.path, page_num+1))
-            elif "prev" in request.POST:
-                return HttpResponseRedirect("%s?page=%s" % (request.path, page_num-1))
+            if "next" in request.POST and page.has_next():
+                return HttpResponseRedirect("%s?after=%s&page=%s" % (
+                    request.path, page.next_after, page.next_page_number()
+                ))
+            elif "prev" in request.POST and page.has_previous():
+                return HttpResponseRedirect("%s?before=%s&page=%s" % (
+                    request.path, page.previous_before, page.previous_page_number()
+                ))
             elif "finish" in request.POST:
                 if not selected:
-                    TransientContact.objects.filter(owner=request.user).delete()
+                    TransientContact.objects.delete_for(request.user)
                     return HttpResponseRedirect(reverse("import_contacts"))
                 # give control over to the callback which is required to
-                # return a HttpResponse
-                response = callback(request, selected)
-                TransientContact.objects.filter(owner=request.user).delete()
+                # return a HttpResponse; it gets the set of string primary
+                # keys it always got
+                response = callback(request, set([str(pk) for pk in selected]))
+                TransientContact.objects.delete_for(request.user)
+                selected.clear()
+                selected.save(request.session)
                 return response
+            return HttpResponseRedirect(request.get_full_path())
         
-        else:
-            form = VcardImportForm()
-            
-            if action == "import_yahoo":
-                yahoo_token = request.session.pop("yahoo_token", None)
-                if yahoo_token:
-                    runner = runner_class(YahooImporter,
-                        user = request.user,
-                        yahoo_token = yahoo_token
-                    )
-                    results = runner.import_contacts()
-                    return _import_success(request, results)
-            
-            elif action == "import_google":
-                authsub_token = request.session.pop("authsub_token", None)
-                if authsub_token:
-                    runner = runner_class(GoogleImporter,
-                        user = request.user,
-                        authsub_token = authsub_token
-                    )
-                    results = runner.import_contacts()
-                    return _import_success(request, results)
-    else:
-        form = VcardImportForm()
+        # "upload_vcard", "import_google" and the like start an import from
+        # the provider named after the underscore
+        kind, sep, provider = action.partition("_")
+        if kind in ("upload", "import") and provider in providers():
+            importer = get_importer(provider)
+            form = _bound_form(request, importer)
+            results = _start_import(request, importer, form, runner_class)
+            if results is not None:
+                return _import_success(request, results)
     
-
     ctx = {
-        "form": form,
+        "form": VcardImportForm(),
         "yahoo_token": request.session.get("yahoo_token"),
         "authsub_token": request.session.get("authsub_token"),
+        "login_urls": _LoginUrls(request),
         "page": page,
         "task_id": request.session.pop("import_contacts_task_id", None),
     }
+    if form is not None:
+        # with its errors, as "form" for vCard uploads, "csv_form" for CSV...
+        ctx["form" if provider == "vcard" else "%s_form" % provider] = form
     
     return render_to_response(template_name, RequestContext(request, ctx))
 
@@ -13,7 +13,10 @@ setup(
     packages = [
         "contacts_import",
         "contacts_import.backends",
+        "contacts_import.management",
+        "contacts_import.management.commands",
         "contacts_import.templatetags",
+        "contacts_import.utils",
     ],
     classifiers = [
         "Development Status :: 3 - Alpha",